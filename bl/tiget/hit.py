@@ -0,0 +1,94 @@
+# BEGIN_COPYRIGHT
+# 
+# Copyright (C) 2013-2014 CRS4.
+# 
+# This file is part of vispa.
+# 
+# vispa is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# vispa is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# vispa.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# END_COPYRIGHT
+
+
+"""
+Compact representation of tabular (blastall -m 8) BLAST hits.
+"""
+
+FIELDS = (
+  "q_id",
+  "s_id",
+  "identity",
+  "al_len",
+  "mismatches",
+  "gap_openings",
+  "q_start",
+  "q_end",
+  "s_start",
+  "s_end",
+  "evalue",
+  "score",
+  )
+
+
+class Hit(object):
+  """
+  A single tabular BLAST hit with typed fields.
+
+  Numeric fields are parsed once, when the hit is read. The e-value is
+  kept as it appears in the input, since nobody does arithmetic on it
+  and its textual format is not easy to reproduce.
+  """
+  __slots__ = FIELDS
+
+  def __init__(self, q_id, s_id, identity, al_len, mismatches,
+               gap_openings, q_start, q_end, s_start, s_end, evalue, score):
+    self.q_id = q_id
+    self.s_id = s_id
+    self.identity = identity
+    self.al_len = al_len
+    self.mismatches = mismatches
+    self.gap_openings = gap_openings
+    self.q_start = q_start
+    self.q_end = q_end
+    self.s_start = s_start
+    self.s_end = s_end
+    self.evalue = evalue
+    self.score = score
+
+  @classmethod
+  def from_line(cls, line, sep=None):
+    """
+    Parse a line of tabular BLAST output.
+
+    By default, fields are split on whitespace, since blastall pads
+    some of them with blanks.
+    """
+    (q_id, s_id, identity, al_len, mismatches, gap_openings,
+     q_start, q_end, s_start, s_end, evalue, score) = line.split(sep)
+    return cls(q_id, s_id, float(identity), int(al_len), int(mismatches),
+               int(gap_openings), int(q_start), int(q_end), int(s_start),
+               int(s_end), evalue, float(score))
+
+  def to_line(self, sep="\t"):
+    """
+    Serialize this hit as a line of tabular BLAST output (no newline).
+    """
+    return sep.join((
+      self.q_id, self.s_id, "%.2f" % self.identity, str(self.al_len),
+      str(self.mismatches), str(self.gap_openings), str(self.q_start),
+      str(self.q_end), str(self.s_start), str(self.s_end), self.evalue,
+      str(self.score),
+      ))
+
+  def __repr__(self):
+    return "Hit(%s)" % ", ".join(repr(getattr(self, n)) for n in FIELDS)
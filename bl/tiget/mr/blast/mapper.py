@@ -26,6 +26,7 @@ import pydoop.utils as pu
 from bl.core.seq.engines.blastall_2_2_21 import Engine
 from bl.core.seq.stats.karlin_altschul import BlastallLKCalculator
 from bl.tiget.repeats import is_repeat
+from bl.tiget.hit import Hit
 import al_type
 
 
@@ -54,15 +55,18 @@ class Mapper(pp.Mapper):
   The output key is al_type.UNAMBIGUOUS, al_type.REPEAT or al_type.NO_HIT.
 
   If there are no hits after filtering, the value is the sequence tag;
-  otherwise, one k/v pair is emitted for each hit, where values are
-  the tabular blast hits (the sequence tag is the first field).
+  otherwise, one k/v pair is emitted for each hit, in order of
+  decreasing score, where values are the query sequence length
+  followed by the tabular blast hit (the sequence tag is the first
+  field of the hit). The sequence length allows to re-apply repeat
+  rules later on without running BLAST again.
 
   @input-record: C{key} does not matter (LineRecordReader), C{value} =
   whole sequence as output by fasta2tab (<HEADER>\t<SEQUENCE>)
 
-  @output-record: tabular blastall hit against the specified db (first
-  field is removed from the hit and emitted as key, so that the
-  tab-separated k/v pair is the original tab-separated output).
+  @output-record: C{key} = alignment type code, C{value} = query
+  length and tabular blastall hit against the specified db, separated
+  by a tab (raw scores replace bit scores).
 
   @jobconf-param: C{bl.mr.log.level} logging level, specified as a
   logging module literal; defaults to 'WARNING'.
@@ -201,24 +205,23 @@ class Mapper(pp.Mapper):
       repeat = is_repeat(len(query_seq), results,
                          self.min_al2seq, self.min_score_diff)
       key = str(al_type.REPEAT) if repeat else str(al_type.UNAMBIGUOUS)
-      for r in results:
-        ctx.emit(key, "\t".join(r))
+      seq_len = len(query_seq)
+      for hit in results:
+        ctx.emit(key, "%d\t%s" % (seq_len, hit.to_line()))
     
   def __filter_results(self, results_stream):
-    for i, r in enumerate(results_stream):
+    for i, hit in enumerate(results_stream):
       if i > self.max_hits:
         break
       self.ctx.incrementCounter(self.hit_counter, 1)
-      identity = float(r[2])  # percentage
-      query_start, query_end = map(int, r[6:8])
-      if query_start > self.max_start:
+      if hit.q_start > self.max_start:
         self.ctx.incrementCounter(self.start_rej_hit_counter, 1)
         continue
-      if identity < self.min_identity:
+      if hit.identity < self.min_identity:  # percentage
         self.ctx.incrementCounter(self.hom_rej_hit_counter, 1)
         continue
-      r[-1] = str(self.__bit2raw(float(r[-1])))
-      yield r
+      hit.score = self.__bit2raw(hit.score)
+      yield hit
     
   def __write_input(self, header, query_seq):
     f = open(self.input_file, "w")
@@ -228,7 +231,7 @@ class Mapper(pp.Mapper):
   def __read_output(self):
     f = open(self.output_file)
     for line in f:
-      yield line.rstrip().split()
+      yield Hit.from_line(line)
     f.close()
 
   def __bit2raw(self, bit_score):
@@ -0,0 +1,95 @@
+# BEGIN_COPYRIGHT
+# 
+# Copyright (C) 2013-2014 CRS4.
+# 
+# This file is part of vispa.
+# 
+# vispa is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# vispa is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# vispa.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# END_COPYRIGHT
+import logging
+from collections import Counter
+logging.basicConfig(level=logging.DEBUG)
+
+import pydoop.pipes as pp
+import pydoop.utils as pu
+from bl.tiget.hit import FIELDS
+import bl.tiget.mr.blast.al_type as al_type
+
+
+# positions in BLAST job output values, after al type code and query length
+CHR_IDX = FIELDS.index("s_id") + 1
+LOCUS_IDX = FIELDS.index("s_start") + 1
+
+
+class Mapper(pp.Mapper):
+  """
+  Maps BLAST job output records to (chromosome, locus) pairs.
+
+  Counts for identical pairs are combined in memory and emitted when
+  the number of distinct pairs reaches a given threshold and when the
+  task ends. Keys are chromosomes, so the default hash partitioner
+  sends all loci for a given chromosome to the same reducer.
+
+  @input-record: C{key} does not matter (LineRecordReader), C{value} =
+  BLAST job output record (alignment type code, query length and
+  tabular hit, separated by tabs). Records for queries with no hits
+  are skipped.
+
+  @output-record: C{key} = chromosome (subject id), C{value} = locus
+  (subject start) and count, separated by a tab.
+
+  @jobconf-param: C{bl.mr.log.level} logging level, specified as a
+  logging module literal; defaults to 'WARNING'.
+
+  @jobconf-param: C{bl.mr.tiget.merge.combine.size} max number of
+  distinct (chromosome, locus) pairs kept in memory; defaults to
+  1000000.
+  """
+  COUNTER_CLASS = "TIGET_MERGE"
+
+  def __init__(self, ctx):
+    super(Mapper, self).__init__(ctx)
+    self.ctx = ctx
+    jc = self.ctx.getJobConf()
+    pu.jc_configure(self, jc, 'bl.mr.log.level', 'log_level', 'WARNING')
+    try:
+      self.log_level = getattr(logging, self.log_level)
+    except AttributeError:
+      raise ValueError("Unsupported log level: %r" % self.log_level)
+    pu.jc_configure_int(self, jc, 'bl.mr.tiget.merge.combine.size',
+                        'combine_size', 1000000)
+    self.logger = logging.getLogger("mapper")
+    self.logger.setLevel(self.log_level)
+    self.hit_counter = self.ctx.getCounter(self.COUNTER_CLASS, "INPUT_HITS")
+    self.counts = Counter()
+
+  def map(self, ctx):
+    code, payload = ctx.getInputValue().rstrip().split("\t", 1)
+    if int(code) == al_type.NO_HIT:
+      return
+    fields = payload.split("\t", LOCUS_IDX + 1)
+    self.counts[(fields[CHR_IDX], int(fields[LOCUS_IDX]))] += 1
+    ctx.incrementCounter(self.hit_counter, 1)
+    if len(self.counts) >= self.combine_size:
+      self.__flush()
+
+  def close(self):
+    self.__flush()
+
+  def __flush(self):
+    self.logger.debug("emitting %d combined loci" % len(self.counts))
+    for (chrom, locus), count in self.counts.iteritems():
+      self.ctx.emit(chrom, "%d\t%d" % (locus, count))
+    self.counts.clear()
@@ -0,0 +1,71 @@
+# BEGIN_COPYRIGHT
+# 
+# Copyright (C) 2013-2014 CRS4.
+# 
+# This file is part of vispa.
+# 
+# vispa is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# vispa is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# vispa.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# END_COPYRIGHT
+import logging
+from collections import Counter
+logging.basicConfig(level=logging.DEBUG)
+
+import pydoop.pipes as pp
+import pydoop.utils as pu
+from bl.tiget.pipeline.merge_redundant import counter_to_arrays, merge_loci
+
+
+class Reducer(pp.Reducer):
+  """
+  Merges redundant integration loci, one chromosome at a time (see
+  bl.tiget.pipeline.merge_redundant).
+
+  @input-record: C{key} = chromosome, C{value} = locus and count,
+  separated by a tab.
+
+  @output-record: C{key} = chromosome, C{value} = merged locus and
+  total count, separated by a tab. Output records have the same
+  format as merge_redundant's output.
+
+  @jobconf-param: C{bl.mr.log.level} logging level, specified as a
+  logging module literal; defaults to 'WARNING'.
+
+  @jobconf-param: C{bl.mr.tiget.merge.window.size} window size;
+  defaults to 3.
+  """
+  def __init__(self, ctx):
+    super(Reducer, self).__init__(ctx)
+    jc = ctx.getJobConf()
+    pu.jc_configure(self, jc, 'bl.mr.log.level', 'log_level', 'WARNING')
+    try:
+      self.log_level = getattr(logging, self.log_level)
+    except AttributeError:
+      raise ValueError("Unsupported log level: %r" % self.log_level)
+    pu.jc_configure_int(self, jc, 'bl.mr.tiget.merge.window.size',
+                        'window_size', 3)
+    self.logger = logging.getLogger("reducer")
+    self.logger.setLevel(self.log_level)
+
+  def reduce(self, ctx):
+    chrom = ctx.getInputKey()
+    counts = Counter()
+    while ctx.nextValue():
+      locus, count = ctx.getInputValue().split("\t")
+      counts[int(locus)] += int(count)
+    self.logger.debug("%s: %d distinct loci" % (chrom, len(counts)))
+    loci, counts = counter_to_arrays(counts)
+    merged_loci, merged_counts = merge_loci(loci, counts, self.window_size)
+    for locus, count in zip(merged_loci.tolist(), merged_counts.tolist()):
+      ctx.emit(chrom, "%d\t%d" % (locus, count))
@@ -25,13 +25,20 @@ Annotate integration sites.
 
 from __future__ import division
 
-import os, argparse, csv, random
-from bisect import bisect
+import os, argparse, csv, random, heapq, itertools, json, struct
+from bisect import bisect, bisect_left
+from operator import itemgetter
 
+import multiprocessing as mp
+
+import numpy as np
 import bl.core.io.bed as bed
 
 
 DEFAULT_OUTPUT_FN = "./annotate.out"
+ANNOTATION_INFO_CACHE = {}
+INDEX_MAGIC = "VISPAIDX"
+INDEX_VERSION = 1
 OUTPUT_FIELDS = [
     ("chrom", "%s"),          # query chromosome
     ("pos", "%d"),            # query position
@@ -41,8 +48,9 @@ OUTPUT_FIELDS = [
     ("strand", "%s"),         # '+' or '-'
     ("tss_d", "%d"),          # distance from transcription start site
     ("rel_pos", "%d"),        # -1: upstream; 0: in_gene; 1: downstream
-    ("integration", "%.2f"),  # integration % (0 if not in-gene)
+    ("integration", "%.2f"),  # integration % (0 if not in-gene or 1-bp)
     ]
+TRACK_FIELDS = OUTPUT_FIELDS[2:]  # per-track fields (multiple tracks)
 
 
 def query_iterator(fn, delimiter="\t", skip_first=False):
@@ -58,49 +66,332 @@ def split_disjoint(interval_seq):
     """
     Split a sequence of intervals into subseqs of disjoint intervals.
 
-    Intervals are assumed to be **sorted** (begin, end) tuples.
+    Intervals are (begin, end) tuples. Taking them in sorted order,
+    each one is appended to the first subseq whose last interval ends
+    no later than it begins, or to a new subseq if there is none. This
+    yields the same subseqs as repeatedly extracting greedy chains of
+    disjoint intervals, in O(n log n) time.
     """
-    interval_seq = sorted(interval_seq)
-    subseqs = [[]]
-    i = 0
-    while interval_seq:
-        interval = interval_seq.pop(i)
-        subseqs[-1].append(interval)
-        i = bisect(interval_seq, (interval[1],))
-        if i >= len(interval_seq) and interval_seq:
+    subseqs = []
+    busy, free = [], []  # (end, subseq index) pairs, subseq indices
+    for interval in sorted(interval_seq):
+        while busy and busy[0][0] <= interval[0]:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            i = heapq.heappop(free)
+        else:
+            i = len(subseqs)
             subseqs.append([])
-            i = 0
-    return subseqs
+        subseqs[i].append(interval)
+        heapq.heappush(busy, (interval[1], i))
+    return subseqs or [[]]
 
 
-def find_closest_on_disjoint(seq, pos):
-    """
-    In a sequence of disjoint intervals, find the one(s) closest to ``pos``.
+class IntervalIndex(object):
 
-    Return a (d, list_of_closest_intervals) tuple where:
+    def __init__(self, subseqs):
+        """
+        Nearest-interval search index for a single chromosome.
 
-    * if pos lies between the endpoints (included), d is 0
-    * otherwise, d is the distance between pos and the closest endpoint
+        subseqs: intervals split into disjoint subseqs, as returned by
+          :func:`split_disjoint`.
 
-    Note that, in most cases, the list will contain only one interval.
-    The only case where it will contain two is the one in which pos is
-    equidistant from the end of an interval and the beginning of the
-    next one.
-    """
-    i = bisect(seq, (pos, float("inf")))
-    if i == 0:
-        return seq[0][0] - pos, [seq[0]]
-    elif i == len(seq):
-        return max(0, pos-seq[-1][1]), [seq[-1]]
-    else:
-        left, right = seq[i-1], seq[i]
-        dl, dr = pos - left[1], right[0] - pos
-        if dr < dl:
-            return dr, [right]
-        elif dr > dl:
-            return max(0, dl), [left]
+        Intervals are stored in a nested containment list: each list
+        holds intervals that do not contain one another, so that both
+        their starts and their ends are sorted, while intervals
+        contained in another one go to the latter's sublist.
+        """
+        self.rank = {}  # interval -> (subseq index, interval)
+        for i, seq in enumerate(subseqs):
+            for interval in seq:
+                self.rank[interval] = (i, interval)
+        self.lists = [[]]
+        self.sublist = {}  # interval -> index of its sublist in self.lists
+        stack = []
+        for interval in sorted(self.rank, key=lambda t: (t[0], -t[1])):
+            while stack and stack[-1][1] < interval[1]:
+                stack.pop()
+            if stack:
+                parent = stack[-1]
+                if parent not in self.sublist:
+                    self.sublist[parent] = len(self.lists)
+                    self.lists.append([])
+                self.lists[self.sublist[parent]].append(interval)
+            else:
+                self.lists[0].append(interval)
+            stack.append(interval)
+        self.starts = [[t[0] for t in l] for l in self.lists]
+        self.ends = [[t[1] for t in l] for l in self.lists]
+        self.intervals = sorted(self.rank, key=self.rank.__getitem__)
+        self.id = dict((t, i) for i, t in enumerate(self.intervals))
+        self.interval_starts, self.interval_ends = np.array(
+            self.intervals, dtype=np.int64
+            ).reshape(-1, 2).T
+        self.interval_subseqs = np.array(
+            [self.rank[t][0] for t in self.intervals], dtype=np.int64
+            )
+        self.__flatten()
+
+    def __flatten(self):
+        # All lists in a single array, with each list's starts and ends
+        # shifted by list index * span so that they are globally sorted
+        # and can be searched for many (position, list) pairs at once.
+        flat = [t for l in self.lists for t in l]
+        offsets = np.cumsum([0] + [len(l) for l in self.lists])
+        self.flat_starts, self.flat_ends = np.array(
+            flat, dtype=np.int64
+            ).reshape(-1, 2).T
+        self.lo = self.flat_starts.min() if flat else 0
+        self.span = (self.flat_ends.max() if flat else 0) - self.lo + 3
+        list_base = np.repeat(np.arange(len(self.lists)) * self.span,
+                              np.diff(offsets))
+        self.key_starts = list_base + self.flat_starts - self.lo + 1
+        self.key_ends = list_base + self.flat_ends - self.lo + 1
+        self.flat_ids = np.array([self.id[t] for t in flat], dtype=np.int64)
+        self.flat_sub = np.array(
+            [self.sublist.get(t, -1) for t in flat], dtype=np.int64
+            )
+        # for each side, the sublist item that shares that endpoint
+        self.flat_sharing = []
+        for side in 0, 1:
+            sharing = np.repeat(-1, len(flat))
+            for i, t in enumerate(flat):
+                if t in self.sublist:
+                    k = self.sublist[t]
+                    child = offsets[k+1] - 1 if side else offsets[k]
+                    if flat[child][side] == t[side]:
+                        sharing[i] = child
+            self.flat_sharing.append(sharing)
+
+    def __containing(self, pos, k=0):
+        starts, ends = self.starts[k], self.ends[k]
+        found = []
+        for interval in self.lists[k][
+            bisect_left(ends, pos):bisect(starts, pos)
+            ]:
+            found.append(interval)
+            if interval in self.sublist:
+                found.extend(self.__containing(pos, self.sublist[interval]))
+        return found
+
+    def __sharing_end(self, interval, side):
+        # interval plus the descendants that share its ``side`` endpoint
+        found = [interval]
+        while interval in self.sublist:
+            interval = self.lists[self.sublist[interval]][-1 if side else 0]
+            if interval[side] != found[0][side]:
+                break
+            found.append(interval)
+        return found
+
+    def __one_per_side(self, pos, found):
+        # Intervals in a subseq can share an endpoint, and a per-subseq
+        # search only sees one of them: the last one that contains (or
+        # ends before) pos and the first one that starts after it.
+        if len(found) < 2:
+            return found
+        best = {}
+        for interval in sorted(found, key=self.rank.__getitem__):
+            if interval[1] < pos:
+                side = -1
+            else:
+                side = 1 if interval[0] > pos else 0
+            key = self.rank[interval][0], side
+            if side <= 0 or key not in best:
+                best[key] = interval
+        return sorted(best.itervalues(), key=self.rank.__getitem__)
+
+    def find_closest(self, pos):
+        """
+        Find the interval(s) closest to ``pos``.
+
+        Return a (d, list_of_closest_intervals) tuple where d is 0 if
+        pos lies between the endpoints (included) of at least one
+        interval, and the distance between pos and the closest endpoint
+        otherwise. The list holds intervals at distance d, sorted by
+        (subseq index, interval). Each subseq contributes at most one
+        interval per side of pos (containing it counts as the left
+        side): when several of its intervals share the relevant
+        endpoint, only the one nearest to pos in subseq order is kept.
+        """
+        found = self.__containing(pos)
+        if found:
+            d = 0
         else:
-            return dl, [left, right]
+            top = self.lists[0]
+            i = bisect(self.starts[0], pos)
+            dl = pos - top[i-1][1] if i > 0 else float("inf")
+            dr = top[i][0] - pos if i < len(top) else float("inf")
+            d = min(dl, dr)
+            if dl == d:
+                found.extend(self.__sharing_end(top[i-1], 1))
+            if dr == d:
+                found.extend(self.__sharing_end(top[i], 0))
+        return d, self.__one_per_side(pos, found)
+
+    def find_closest_batch(self, positions):
+        """
+        Vectorized :meth:`find_closest` for an array of positions.
+
+        Return (q, ids, d) arrays with one element for each closest
+        interval: the position's index in ``positions``, the interval's
+        index in self.intervals and the distance. Results are sorted by
+        (q, ids), so intervals are in the same order as in
+        :meth:`find_closest`.
+
+        Each level of the index is searched for all positions at once.
+        """
+        pos = np.asarray(positions, dtype=np.int64)
+        keys = np.clip(pos - self.lo + 1, 0, self.span - 1)
+        q, ids, dist = [[np.empty(0, dtype=np.int64)] for _ in xrange(3)]
+        # containing intervals, one nesting level at a time
+        qk, k = np.arange(len(pos)), np.zeros(len(pos), dtype=np.int64)
+        while len(qk):
+            base = k * self.span + keys[qk]
+            i = self.key_starts.searchsorted(base, side="right")
+            j = self.key_ends.searchsorted(base, side="left")
+            n = np.maximum(i-j, 0)
+            qk = np.repeat(qk, n)
+            f = np.repeat(j, n) + np.arange(len(qk)) - np.repeat(
+                np.cumsum(n) - n, n
+                )
+            q.append(qk)
+            ids.append(self.flat_ids[f])
+            dist.append(np.zeros(len(qk), dtype=np.int64))
+            nested = self.flat_sub[f] >= 0
+            qk, k = qk[nested], self.flat_sub[f[nested]]
+        # closest top-level intervals (and descendants sharing the
+        # closest endpoint) for positions not contained in any interval
+        inside = np.zeros(len(pos), dtype=bool)
+        inside[np.concatenate(q)] = True
+        n_top = len(self.lists[0])
+        top = self.key_starts[:n_top].searchsorted(keys, side="right")
+        li, ri = np.maximum(top-1, 0), np.minimum(top, n_top-1)
+        far = np.iinfo(np.int64).max
+        dl = np.where(top > 0, pos - self.flat_ends[li], far)
+        dr = np.where(top < n_top, self.flat_starts[ri] - pos, far)
+        d = np.minimum(dl, dr)
+        for side, mask, f in (1, dl == d, li), (0, dr == d, ri):
+            qk = np.flatnonzero(mask & ~inside)
+            f = f[qk]
+            while len(qk):
+                q.append(qk)
+                ids.append(self.flat_ids[f])
+                dist.append(d[qk])
+                f = self.flat_sharing[side][f]
+                qk, f = qk[f >= 0], f[f >= 0]
+        q, ids, dist = [np.concatenate(_) for _ in (q, ids, dist)]
+        order = np.lexsort((ids, q))
+        q, ids, dist = q[order], ids[order], dist[order]
+        # one interval per (position, subseq, side), as in find_closest:
+        # within a subseq, sides are contiguous in id order
+        sub = self.interval_subseqs[ids]
+        side = np.where(self.interval_ends[ids] < pos[q], -1,
+                        (self.interval_starts[ids] > pos[q]).astype(int))
+        same_next = np.zeros(len(q), dtype=bool)
+        same_next[:-1] = ((q[1:] == q[:-1]) & (sub[1:] == sub[:-1]) &
+                          (side[1:] == side[:-1]))
+        same_prev = np.zeros(len(q), dtype=bool)
+        same_prev[1:] = same_next[:-1]
+        keep = np.where(side > 0, ~same_prev, ~same_next)
+        return q[keep], ids[keep], dist[keep]
+
+
+def _aligned(n, alignment=8):
+    return n + (-n) % alignment
+
+
+class AnnotationIndexFile(object):
+
+    def __init__(self, fn):
+        """
+        Read-only, memory-mapped annotation index (see :func:`write_index`).
+
+        The file starts with INDEX_MAGIC, followed by the length of a
+        JSON table of contents and by the table itself. Arrays follow,
+        each starting at a multiple of 8 bytes. For each chromosome,
+        the index holds the unique intervals, sorted by disjoint subseq
+        (see :func:`split_disjoint`) and position, the subseq index of
+        each interval and, in CSR form, the name and strand ids of the
+        features associated to each interval. Ids point to a string
+        table shared by all chromosomes.
+        """
+        with open(fn, "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("%r is not an annotation index" % (fn,))
+            toc_len, = struct.unpack("<Q", f.read(8))
+            self.toc = json.loads(f.read(toc_len))
+        if self.toc["version"] != INDEX_VERSION:
+            raise ValueError("unsupported index version: %r" %
+                             self.toc["version"])
+        self.data = np.memmap(fn, dtype=np.uint8, mode="r")
+        self.data_start = _aligned(len(INDEX_MAGIC) + 8 + toc_len)
+        self.chroms = frozenset(str(_) for _ in self.toc["chroms"])
+        self.__strings = {}
+
+    @staticmethod
+    def is_index(fn):
+        with open(fn, "rb") as f:
+            return f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+    def array(self, ref):
+        dtype, offset, length = ref
+        return np.frombuffer(self.data, dtype=np.dtype(str(dtype)),
+                             count=length, offset=self.data_start+offset)
+
+    def string(self, i):
+        try:
+            return self.__strings[i]
+        except KeyError:
+            toc = self.toc["strings"]
+            offsets = self.array(toc["offsets"])
+            s = self.__strings[i] = self.array(toc["blob"])[
+                offsets[i]:offsets[i+1]
+                ].tostring()
+            return s
+
+    def load(self, chrom):
+        """
+        Return (subseqs, features) for ``chrom``, in the same format as
+        AnnotationInfo's interval_info and add_info values.
+        """
+        toc = self.toc["chroms"][chrom]
+        starts, ends, subseq_ids, offsets, names, strands = [
+            self.array(toc[k]).tolist() for k in (
+                "starts", "ends", "subseqs", "offsets", "names", "strands"
+                )
+            ]
+        subseqs, features = [], {}
+        for i, interval in enumerate(itertools.izip(starts, ends)):
+            if i == 0 or subseq_ids[i] != subseq_ids[i-1]:
+                subseqs.append([])
+            subseqs[-1].append(interval)
+            features[interval] = set(
+                (self.string(names[k]), self.string(strands[k]))
+                for k in xrange(offsets[i], offsets[i+1])
+                )
+        return subseqs, features
+
+
+class LazyChromDict(dict):
+    """
+    A dict whose values are loaded on first access, by calling
+    ``load(key)``, for a fixed set of keys. Iteration only covers
+    values that have already been loaded.
+    """
+    def __init__(self, keys, load):
+        super(LazyChromDict, self).__init__()
+        self.__keys = keys
+        self.__load = load
+
+    def __contains__(self, key):
+        return key in self.__keys
+
+    def __missing__(self, key):
+        if key not in self.__keys:
+            raise KeyError(key)
+        self.__load(key)
+        return dict.__getitem__(self, key)
 
 
 class AnnotationInfo(object):
@@ -141,6 +432,9 @@ class AnnotationInfo(object):
         self.add_info = add_info or {}
         self.__loaded = self.interval_info and self.add_info
         self.__split = False
+        self.index = {}
+        self.features = {}
+        self.density_index = {}
 
     def load_from_bed(self, bed_fn):
         if self.__loaded:
@@ -156,6 +450,27 @@ class AnnotationInfo(object):
                 subd.setdefault(interval, set()).add((r["name"], r["strand"]))
         self.__loaded = True
 
+    def load_from_index(self, index_fn):
+        """
+        Load annotation info from an index built with :func:`write_index`.
+
+        Chromosomes are loaded when first accessed; since the index
+        stores intervals already split into disjoint subseqs,
+        :meth:`split_all` has nothing to do.
+        """
+        if self.__loaded:
+            return
+        index_file = AnnotationIndexFile(index_fn)
+
+        def load(chrom):
+            subseqs, features = index_file.load(chrom)
+            dict.__setitem__(self.interval_info, chrom, subseqs)
+            dict.__setitem__(self.add_info, chrom, features)
+
+        self.interval_info = LazyChromDict(index_file.chroms, load)
+        self.add_info = LazyChromDict(index_file.chroms, load)
+        self.__loaded = self.__split = True
+
     def split_all(self):
         if self.__split:
             return
@@ -163,14 +478,68 @@ class AnnotationInfo(object):
             self.interval_info[chrom] = split_disjoint(data)
         self.__split = True
 
-    def find_closest(self, chrom, pos):
+    def get_index(self, chrom):
         self.split_all()
-        ranking = {}
-        for seq in self.interval_info[chrom]:
-            d, closest_list = find_closest_on_disjoint(seq, pos)
-            ranking.setdefault(d, []).extend(closest_list)
-        min_d = min(ranking)
-        return min_d, ranking[min_d]
+        try:
+            return self.index[chrom]
+        except KeyError:
+            index = self.index[chrom] = IntervalIndex(
+                self.interval_info[chrom]
+                )
+            return index
+
+    def find_closest(self, chrom, pos):
+        return self.get_index(chrom).find_closest(pos)
+
+    def get_features(self, chrom):
+        """
+        Get (names, strands, offsets) arrays for ``chrom``, where the
+        features of the i-th interval in the index are at positions
+        offsets[i] to offsets[i+1] (excluded) of names and strands.
+        """
+        try:
+            return self.features[chrom]
+        except KeyError:
+            pass
+        subd = self.add_info[chrom]
+        names, strands, offsets = [], [], [0]
+        for interval in self.get_index(chrom).intervals:
+            for name, strand in subd[interval]:
+                names.append(name)
+                strands.append(strand)
+            offsets.append(len(names))
+        features = self.features[chrom] = (
+            np.array(names, dtype=object), np.array(strands, dtype=object),
+            np.array(offsets, dtype=np.int64)
+            )
+        return features
+
+    def density(self, chrom, positions, windows):
+        """
+        Count features near each of ``positions`` in ``chrom``.
+
+        Return an array with one row per position and one column per
+        window size w in ``windows``, holding the number of features
+        that overlap [pos - w, pos + w]. Each count takes two binary
+        searches, on interval starts and ends sorted once per chrom.
+        """
+        try:
+            starts, start_counts, ends, end_counts = self.density_index[chrom]
+        except KeyError:
+            index = self.get_index(chrom)
+            n_features = np.diff(self.get_features(chrom)[2])
+            arrays = []
+            for a in index.interval_starts, index.interval_ends:
+                order = a.argsort(kind="mergesort")
+                arrays.extend([a[order], np.concatenate(
+                    ([0], np.cumsum(n_features[order]))
+                    )])
+            starts, start_counts, ends, end_counts = arrays
+            self.density_index[chrom] = arrays
+        pos = np.asarray(positions, dtype=np.int64)[:, np.newaxis]
+        w = np.asarray(windows, dtype=np.int64)
+        return (start_counts[starts.searchsorted(pos + w, side="right")] -
+                end_counts[ends.searchsorted(pos - w, side="left")])
 
     def annotate(self, chrom, pos, multi=False):
         min_d, interval_list = self.find_closest(chrom, pos)
@@ -186,7 +555,10 @@ class AnnotationInfo(object):
                 res["tss_d"] = abs(pos - tss)
                 if min_d == 0:
                     res["rel_pos"] = 0  # in-gene
-                    res["integration"] = 100 * res["tss_d"] / length
+                    # a 1-bp feature can only contain its own tss
+                    res["integration"] = (
+                        100 * res["tss_d"] / length if length else 0
+                        )
                 else:
                     if ((strand == '+' and pos < left) or
                         (strand == '-' and pos > right)):
@@ -199,14 +571,137 @@ class AnnotationInfo(object):
             results = random.sample(results, 1)
         return results
 
+    def annotate_batch(self, chrom, positions, multi=False):
+        """
+        Annotate all ``positions`` in ``chrom`` at once.
 
-def get_annotation_info(bed_fn):
+        Results are the same as those of :meth:`annotate`, but they are
+        returned as a dict that maps field names (see OUTPUT_FIELDS) to
+        arrays, with all results for a position in consecutive rows,
+        in the same order as ``positions``. The "index" array holds the
+        index in ``positions`` for each row.
+        """
+        index = self.get_index(chrom)
+        names, strands, offsets = self.get_features(chrom)
+        q, ids, d = index.find_closest_batch(positions)
+        n_features = offsets[ids+1] - offsets[ids]
+        q, ids, d = [np.repeat(_, n_features) for _ in (q, ids, d)]
+        ends = np.cumsum(n_features)
+        f = offsets[ids] + np.arange(len(q)) - np.repeat(
+            ends - n_features, n_features
+            )
+        if not multi:
+            counts = np.bincount(q, minlength=len(positions))
+            pick = np.cumsum(counts) - counts
+            pick += (np.random.random_sample(len(counts)) * counts).astype(
+                np.int64
+                )
+            q, ids, d, f = q[pick], ids[pick], d[pick], f[pick]
+        pos = np.asarray(positions, dtype=np.int64)[q]
+        left, right = index.interval_starts[ids], index.interval_ends[ids]
+        strand = strands[f]
+        plus, minus = strand == '+', strand == '-'
+        tss_d = np.abs(pos - np.where(plus, left, right))
+        upstream = (plus & (pos < left)) | (minus & (pos > right))
+        inside = d == 0
+        length = right - left
+        integration = np.where(
+            inside & (length > 0), 100 * tss_d / np.maximum(length, 1), 0
+            )
+        return {
+            "chrom": [chrom] * len(q),
+            "pos": pos,
+            "name": names[f],
+            "start": left,
+            "end": right,
+            "strand": strand,
+            "tss_d": tss_d,
+            "rel_pos": np.where(inside, 0, np.where(upstream, -1, 1)),
+            "integration": integration,
+            "index": q,
+            }
+
+
+def get_annotation_info(annot_fn):
+    """
+    Get annotation info from either a BED file or an index file built
+    with :func:`write_index`.
+    """
     annotation_info = AnnotationInfo()
-    annotation_info.load_from_bed(bed_fn)
-    annotation_info.split_all()
+    if AnnotationIndexFile.is_index(annot_fn):
+        annotation_info.load_from_index(annot_fn)
+    else:
+        annotation_info.load_from_bed(annot_fn)
+        annotation_info.split_all()
     return annotation_info
 
 
+def get_cached_annotation_info(annot_fn):
+    """
+    Like :func:`get_annotation_info`, but only loads each file once per
+    process. Worker processes forked after the first call share the
+    parent's annotation info.
+    """
+    if annot_fn not in ANNOTATION_INFO_CACHE:
+        ANNOTATION_INFO_CACHE[annot_fn] = get_annotation_info(annot_fn)
+    return ANNOTATION_INFO_CACHE[annot_fn]
+
+
+def write_index(annotation_info, fn):
+    """
+    Write ``annotation_info`` to a binary index file (see
+    :class:`AnnotationIndexFile`).
+    """
+    annotation_info.split_all()
+    arrays, size = [], [0]
+    string_ids = {}
+
+    def add_array(a):
+        ref = [a.dtype.str, size[0], len(a)]
+        arrays.append(a)
+        size[0] = _aligned(size[0] + a.nbytes)
+        return ref
+
+    def string_id(s):
+        return string_ids.setdefault(s, len(string_ids))
+
+    toc = {"version": INDEX_VERSION, "chroms": {}}
+    for chrom in sorted(annotation_info.interval_info):
+        subseqs = annotation_info.interval_info[chrom]
+        features = annotation_info.add_info[chrom]
+        intervals = [t for seq in subseqs for t in seq]
+        offsets, names, strands = [0], [], []
+        for interval in intervals:
+            for name, strand in features[interval]:
+                names.append(string_id(name))
+                strands.append(string_id(strand))
+            offsets.append(len(names))
+        starts, ends = np.array(intervals, dtype="<i8").reshape(-1, 2).T
+        toc["chroms"][chrom] = {
+            "starts": add_array(starts),
+            "ends": add_array(ends),
+            "subseqs": add_array(np.repeat(
+                np.arange(len(subseqs), dtype="<i4"), map(len, subseqs)
+                )),
+            "offsets": add_array(np.array(offsets, dtype="<i8")),
+            "names": add_array(np.array(names, dtype="<i4")),
+            "strands": add_array(np.array(strands, dtype="<i4")),
+            }
+    strings = sorted(string_ids, key=string_ids.get)
+    toc["strings"] = {
+        "offsets": add_array(np.cumsum([0] + map(len, strings)).astype("<i8")),
+        "blob": add_array(np.fromstring("".join(strings), dtype=np.uint8)),
+        }
+    toc = json.dumps(toc)
+    with open(fn, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack("<Q", len(toc)))
+        f.write(toc)
+        for a in arrays:
+            f.write("\0" * (_aligned(f.tell()) - f.tell()))
+            a.tofile(f)
+
+
 def make_parser():
     parser = argparse.ArgumentParser(
       description=__doc__.strip(),
@@ -214,8 +709,18 @@ def make_parser():
       )
     parser.add_argument("input", metavar="INPUT",
                         help="merged integration sites in tabular format")
-    parser.add_argument("annot", metavar="ANNOTATION",
-                        help="annotation info in BED format")
+    parser.add_argument("annot", metavar="ANNOTATION", nargs="+",
+                        help="annotation info in BED format, or an index "
+                        "built with build_index. With more than one "
+                        "annotation track, output has one row per IS, "
+                        "with per-track columns")
+    parser.add_argument("--track-names", metavar="STRING",
+                        help="comma-separated track names, for the header "
+                        "of multi-track output [annotation file names]")
+    parser.add_argument("--density", metavar="STRING",
+                        help="comma-separated window sizes: for each IS, "
+                        "also output the number of features within each "
+                        "distance (e.g., 10000,100000,1000000)")
     parser.add_argument("-o", "--output", metavar="STRING",
                         default=DEFAULT_OUTPUT_FN, help="output file")
     parser.add_argument("-d", "--delimiter", metavar="STRING",
@@ -224,25 +729,156 @@ def make_parser():
                         help="skip first line (e.g., header)")
     parser.add_argument("--multi", action="store_true",
                         help="output multiple lines per IS")
+    parser.add_argument("--batch", action="store_true",
+                        help="annotate runs of IS on the same chromosome "
+                        "all at once (fast for sorted input)")
+    parser.add_argument("--processes", metavar="INT", type=int, default=1,
+                        help="n. of worker processes (each one annotates "
+                        "runs of IS on the same chromosome)")
     return parser
 
 
+def annotate_grouped(annotation_info, chrom, positions, multi=False,
+                     batch=False, fields=OUTPUT_FIELDS):
+    """
+    Annotate ``positions`` in ``chrom``. Return, for each position, the
+    list of its results as lists of formatted ``fields``, or None if
+    there is no annotation for chrom.
+    """
+    if chrom not in annotation_info.add_info:
+        return None
+    if not batch:
+        return [[[t % r[n] for n, t in fields]
+                 for r in annotation_info.annotate(chrom, pos, multi=multi)]
+                for pos in positions]
+    res = annotation_info.annotate_batch(
+        chrom, np.array(positions, dtype=np.int64), multi=multi
+        )
+    columns = [(t, list(res[n])) for n, t in fields]
+    grouped = [[] for _ in positions]
+    for i, k in enumerate(res["index"].tolist()):
+        grouped[k].append([t % c[i] for t, c in columns])
+    return grouped
+
+
+def annotate_tracks(annotation_infos, chrom, positions, multi=False,
+                    batch=False, windows=()):
+    """
+    Annotate ``positions`` in ``chrom`` with one or more tracks.
+
+    Return (rows, unknown), where unknown lists the indices of tracks
+    with no annotation for chrom. With a single track, rows are in the
+    same format as the single-track output (see OUTPUT_FIELDS).
+    Otherwise, there is exactly one row per position: chrom and pos,
+    followed by TRACK_FIELDS for each track, with values for multiple
+    features separated by commas (empty if chrom is unknown).
+
+    If ``windows`` is not empty, the feature counts for each window
+    size (see :meth:`AnnotationInfo.density`) follow the fields of each
+    result (single track) or of each track (multiple tracks).
+    """
+    unknown = []
+    if len(annotation_infos) == 1:
+        grouped = annotate_grouped(
+            annotation_infos[0], chrom, positions, multi, batch
+            )
+        if grouped is None:
+            return [], [0]
+        if windows:
+            counts = annotation_infos[0].density(chrom, positions, windows)
+            for results, c in zip(grouped, counts.tolist()):
+                for r in results:
+                    r.extend("%d" % _ for _ in c)
+        return [r for results in grouped for r in results], unknown
+    rows = [[chrom, "%d" % pos] for pos in positions]
+    for i, annotation_info in enumerate(annotation_infos):
+        grouped = annotate_grouped(annotation_info, chrom, positions, multi,
+                                   batch, TRACK_FIELDS)
+        if grouped is None:
+            unknown.append(i)
+            n_fields = len(TRACK_FIELDS) + len(windows)
+            for row in rows:
+                row.extend([""] * n_fields)
+            continue
+        for row, results in zip(rows, grouped):
+            row.extend(",".join(col) for col in zip(*results))
+        if windows:
+            counts = annotation_info.density(chrom, positions, windows)
+            for row, c in zip(rows, counts.tolist()):
+                row.extend("%d" % _ for _ in c)
+    return rows, unknown
+
+
+def reseed():
+    random.seed()
+    np.random.seed()
+
+
+def annotate_worker(args):
+    annot_fns, chrom, positions, multi, batch, windows = args
+    return chrom, annotate_tracks(
+        [get_cached_annotation_info(fn) for fn in annot_fns],
+        chrom, positions, multi, batch, windows
+        )
+
+
 def main(argv):
     parser = make_parser()
     args = parser.parse_args(argv[1:])
-    annotation_info = get_annotation_info(args.annot)
+    if args.track_names:
+        track_names = args.track_names.split(",")
+        if len(track_names) != len(args.annot):
+            parser.error("n. of track names must match n. of annotations")
+    else:
+        track_names = [os.path.splitext(os.path.basename(_))[0]
+                       for _ in args.annot]
+    try:
+        windows = tuple(int(_) for _ in args.density.split(",")
+                        ) if args.density else ()
+    except ValueError:
+        parser.error("--density: window sizes must be integers")
+    annotation_infos = [get_cached_annotation_info(_) for _ in args.annot]
     unknown_tags = set()
-    with open(args.output, "w") as fo:
-        writer = csv.writer(
-            fo, delimiter=args.delimiter, lineterminator=os.linesep
-            )
-        for chrom, pos in query_iterator(
-            args.input, args.delimiter, args.skip_first
-            ):
-            if chrom in annotation_info.add_info:
-                for r in annotation_info.annotate(chrom, pos, multi=args.multi):
-                    writer.writerow([t % r[n] for n, t in OUTPUT_FIELDS])
-            else:
-                unknown_tags.add(chrom)
-    for t in sorted(unknown_tags):
-        print 'no annotation for "%s"' % t
+    queries = query_iterator(args.input, args.delimiter, args.skip_first)
+    runs = ((chrom, [p for _, p in group])
+            for chrom, group in itertools.groupby(queries, itemgetter(0)))
+    if args.processes > 1:
+        # workers inherit the annotation info loaded above
+        pool = mp.Pool(args.processes, initializer=reseed)
+        results = pool.imap(annotate_worker, (
+            (args.annot, chrom, positions, args.multi, args.batch, windows)
+            for chrom, positions in runs
+            ))
+    else:
+        pool = None
+        results = ((chrom, annotate_tracks(
+            annotation_infos, chrom, positions, args.multi, args.batch,
+            windows
+            )) for chrom, positions in runs)
+    try:
+        with open(args.output, "w") as fo:
+            writer = csv.writer(
+                fo, delimiter=args.delimiter, lineterminator=os.linesep
+                )
+            if len(args.annot) > 1:
+                writer.writerow(["chrom", "pos"] + [
+                    "%s_%s" % (track, n) for track in track_names
+                    for n in [n for n, _ in TRACK_FIELDS] +
+                    ["n_%d" % w for w in windows]
+                    ])
+            for chrom, (rows, unknown) in results:
+                writer.writerows(rows)
+                unknown_tags.update((i, chrom) for i in unknown)
+    except:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for i, t in sorted(unknown_tags):
+        if len(args.annot) > 1:
+            print 'no annotation for "%s" in %s' % (t, track_names[i])
+        else:
+            print 'no annotation for "%s"' % t
@@ -0,0 +1,56 @@
+# BEGIN_COPYRIGHT
+# 
+# Copyright (C) 2013-2014 CRS4.
+# 
+# This file is part of vispa.
+# 
+# vispa is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# vispa is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# vispa.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# END_COPYRIGHT
+
+"""
+Build a binary annotation index from a BED file.
+
+The index can be passed to annotate in place of the BED file: it is
+memory-mapped and chromosomes are loaded only when first needed, with
+no BED parsing or interval splitting.
+"""
+
+import sys, argparse
+
+from bl.tiget.pipeline.annotate import AnnotationInfo, write_index
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+      description=__doc__.strip(),
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      )
+    parser.add_argument("input", metavar="INPUT",
+                        help="annotation info in BED format")
+    parser.add_argument("output", metavar="OUTPUT", help="index file")
+    return parser
+
+
+def main(argv):
+    parser = make_parser()
+    args = parser.parse_args(argv[1:])
+    annotation_info = AnnotationInfo()
+    annotation_info.load_from_bed(args.input)
+    write_index(annotation_info, args.output)
+    print "wrote index to %s" % args.output
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -22,15 +22,30 @@
 """
 Demultiplex sequence data according to a set of barcodes.
 
-Input format: FASTA; mismatches allowed: 0.
+Input format: FASTA. By default, reads must start with a barcode
+exactly; with --max-mismatches K, they are assigned to the barcode
+whose Hamming distance from the start of the read is at most K and
+strictly lower than that of any other barcode of the same length.
+
+With --dual, reads are split by sample according to a barcode at each
+end, in a single pass: the barcode file must be a sample sheet with
+one (sample, 5' barcode, 3' barcode) triple per line, and reads must
+end with the reverse complement of the 3' barcode.
 """
-import os, argparse, errno
-from collections import Counter
+import sys, os, argparse, errno, tempfile, shutil, string
+import multiprocessing as mp
+from collections import Counter, OrderedDict
+from itertools import combinations, product
 
 from bl.core.seq.io.fasta import SimpleFastaReader as FastaReader
 
 
 DEFAULT_OUTPUT_DIR = os.getcwd()
+ALPHABET = "ACGTN"
+DEFAULT_MAX_OPEN = 256
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_MAX_BUFFERED = 64 * 1024 * 1024
+RC_TABLE = string.maketrans("ACGTNacgtn", "TGCANtgcan")
 
 
 def get_barcodes(fn):
@@ -38,22 +53,379 @@ def get_barcodes(fn):
         return set(line.strip() for line in f)
 
 
-def demux_fasta(f, barcodes, outdir=DEFAULT_OUTPUT_DIR):
-    out_map = dict.fromkeys(barcodes)
+def get_sample_sheet(fn):
+    """
+    Read a dual barcode sample sheet, with one whitespace-separated
+    (sample, 5' barcode, 3' barcode) triple per line.
+
+    Return a dict that maps (5' barcode, 3' barcode) pairs to sample
+    names. The same sample can be listed for more than one pair.
+    """
+    sample_sheet = {}
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                sample, bc5, bc3 = line.split()
+            except ValueError:
+                raise ValueError("bad sample sheet line: %r" % (line,))
+            if (bc5, bc3) in sample_sheet:
+                raise ValueError("duplicate barcode pair: %s, %s" % (bc5, bc3))
+            sample_sheet[(bc5, bc3)] = sample
+    return sample_sheet
+
+
+def reverse_complement(seq):
+    return seq.translate(RC_TABLE)[::-1]
+
+
+def hamming_neighbours(seq, max_d, alphabet=ALPHABET):
+    """
+    Generate all (s, d) pairs such that s is at Hamming distance d <=
+    max_d from seq. The first pair is always (seq, 0).
+    """
+    yield seq, 0
+    for d in xrange(1, max_d + 1):
+        for positions in combinations(xrange(len(seq)), d):
+            choices = [[c for c in alphabet if c != seq[p]]
+                       for p in positions]
+            for subs in product(*choices):
+                s = list(seq)
+                for p, c in zip(positions, subs):
+                    s[p] = c
+                yield "".join(s), d
+
+
+def index_barcodes(barcodes, max_mismatches=0):
+    """
+    Build a lookup index for the given barcodes.
+
+    Return an (index, ambiguous) tuple. ``index`` is a list of (length,
+    bc_map) pairs, one for each distinct barcode length, where bc_map
+    maps every sequence within ``max_mismatches`` of a barcode of that
+    length to the barcode itself: the barcode that a read should be
+    assigned to is found with one lookup of ``read[:length]`` for each
+    length. Sequences that are equally close to more than one barcode
+    are left out of the index and returned in the ``ambiguous`` dict,
+    which maps them to the set of competing barcodes.
+    """
+    by_len = {}
+    for bc in barcodes:
+        by_len.setdefault(len(bc), set()).add(bc)
+    index, ambiguous = [], {}
+    for L, bc_set in sorted(by_len.iteritems()):
+        closest = {}
+        for bc in bc_set:
+            for s, d in hamming_neighbours(bc, max_mismatches):
+                old = closest.get(s)
+                if old is None or d < old[0]:
+                    closest[s] = (d, {bc})
+                elif d == old[0]:
+                    old[1].add(bc)
+        bc_map = {}
+        for s, (d, matches) in closest.iteritems():
+            if len(matches) > 1:
+                ambiguous[s] = matches
+            else:
+                bc_map[s] = matches.pop()
+        index.append((L, bc_map))
+    return index, ambiguous
+
+
+class OutputPool(object):
+
+    def __init__(self, paths, max_open=DEFAULT_MAX_OPEN,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 max_buffered=DEFAULT_MAX_BUFFERED):
+        """
+        Buffered writers for a large number of output files.
+
+        paths: a dict that maps keys to output file paths. All files are
+          created (or truncated) immediately.
+
+        Data written for each key is kept in memory until it reaches
+        ``buffer_size`` bytes, then it's appended to the corresponding
+        file in a single call. At most ``max_open`` files are kept open
+        at any time: when the limit is reached, the least recently
+        used one is closed.
+
+        Without a global limit, memory use would grow up to
+        ``len(paths) * buffer_size`` bytes, which can be large with
+        many barcodes. When the total amount of buffered data exceeds
+        ``max_buffered`` bytes, the largest buffers are flushed until
+        it's down to half that value.
+        """
+        if max_open < 1:
+            raise ValueError("max_open must be positive")
+        self.paths = paths
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.buffers = dict((k, []) for k in paths)
+        self.buffered = dict.fromkeys(paths, 0)
+        self.total = 0
+        self.handles = OrderedDict()
+        for path in paths.itervalues():
+            open(path, "w").close()
+
+    def __get_handle(self, key):
+        try:
+            f = self.handles.pop(key)
+        except KeyError:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            f = open(self.paths[key], "a")
+        self.handles[key] = f
+        return f
+
+    def write(self, key, data):
+        self.buffers[key].append(data)
+        self.buffered[key] += len(data)
+        self.total += len(data)
+        if self.buffered[key] >= self.buffer_size:
+            self.flush(key)
+        elif self.total > self.max_buffered:
+            self.__shrink()
+
+    def __shrink(self):
+        target = self.max_buffered // 2
+        by_size = sorted(self.buffered, key=self.buffered.get, reverse=True)
+        for key in by_size:
+            if self.total <= target:
+                break
+            self.flush(key)
+
+    def flush(self, key):
+        buf = self.buffers[key]
+        if buf:
+            self.__get_handle(key).write("".join(buf))
+            del buf[:]
+            self.total -= self.buffered[key]
+            self.buffered[key] = 0
+
+    def close(self):
+        try:
+            for key in self.buffers:
+                self.flush(key)
+        finally:
+            for f in self.handles.itervalues():
+                f.close()
+            self.handles.clear()
+
+
+def demux_fasta(f, barcodes, outdir=DEFAULT_OUTPUT_DIR, index=None,
+                max_open=DEFAULT_MAX_OPEN, buffer_size=DEFAULT_BUFFER_SIZE,
+                max_buffered=DEFAULT_MAX_BUFFERED):
+    """
+    Split reads from FASTA stream ``f`` according to ``barcodes``.
+
+    Return a (seq_count, out_map) tuple, where ``out_map`` maps each
+    barcode to the corresponding output file path.
+
+    If ``index`` is not provided, it is built by
+    :func:`index_barcodes`, with no mismatches allowed. ``max_open``,
+    ``buffer_size`` and ``max_buffered`` are passed on to
+    :class:`OutputPool`.
+    """
+    out_map = dict((bc, os.path.join(outdir, bc) + '.fa') for bc in barcodes)
     seq_count = Counter()
+    if index is None:
+        index = index_barcodes(barcodes)[0]
+    pool = OutputPool(out_map, max_open=max_open, buffer_size=buffer_size,
+                      max_buffered=max_buffered)
     try:
-        for bc in out_map:
-            out_map[bc] = open(os.path.join(outdir, bc) + '.fa', 'w')
         reader = FastaReader(f)
         for header, seq in reader:
-            for bc in barcodes:
-                if seq.startswith(bc):
-                    out_map[bc].write(">%s\n%s\n" % (header, seq))
+            for L, bc_map in index:
+                bc = bc_map.get(seq[:L])
+                if bc is not None:
+                    pool.write(bc, ">%s\n%s\n" % (header, seq))
                     seq_count[bc] += 1
     finally:
-        for outf in out_map.itervalues():
-            if outf is not None:
-                outf.close()
+        pool.close()
+    return seq_count, out_map
+
+
+def index_sample_sheet(sample_sheet, max_mismatches=0):
+    """
+    Build lookup indices for both ends of the reads.
+
+    3' barcodes in the sample sheet are read from the opposite strand,
+    so reads are expected to end with their reverse complement: the 3'
+    index is built on the reverse complements, and maps them back to
+    the original barcodes.
+
+    Return an ((index5, index3), (ambiguous5, ambiguous3)) tuple: see
+    :func:`index_barcodes`. The two ambiguity dicts are kept apart,
+    since the same sequence can be ambiguous at both ends.
+    """
+    bc5_set = set(bc5 for bc5, _ in sample_sheet)
+    rc3_set = set(reverse_complement(bc3) for _, bc3 in sample_sheet)
+    index5, ambiguous5 = index_barcodes(bc5_set, max_mismatches)
+    rc_index3, rc_ambiguous = index_barcodes(rc3_set, max_mismatches)
+    index3 = [(L, dict((s, reverse_complement(rc))
+                       for s, rc in bc_map.iteritems()))
+              for L, bc_map in rc_index3]
+    ambiguous3 = dict((s, set(reverse_complement(_) for _ in matches))
+                      for s, matches in rc_ambiguous.iteritems())
+    return (index5, index3), (ambiguous5, ambiguous3)
+
+
+def demux_fasta_dual(f, sample_sheet, outdir=DEFAULT_OUTPUT_DIR,
+                     index=None, max_open=DEFAULT_MAX_OPEN,
+                     buffer_size=DEFAULT_BUFFER_SIZE,
+                     max_buffered=DEFAULT_MAX_BUFFERED):
+    """
+    Split reads from FASTA stream ``f`` according to a barcode at each
+    end, in a single pass.
+
+    ``sample_sheet`` maps (5' barcode, 3' barcode) pairs to sample
+    names (see :func:`get_sample_sheet`). A read goes to a sample if
+    it starts with the 5' barcode and ends with the reverse complement
+    of the 3' barcode. A read that matches more than one pair is
+    written (and counted) once for each matching sample.
+
+    Return a (seq_count, out_map) tuple, keyed by sample name. If
+    ``index`` is not provided, it is built by
+    :func:`index_sample_sheet`, with no mismatches allowed.
+    """
+    out_map = dict((s, os.path.join(outdir, s) + '.fa')
+                   for s in set(sample_sheet.itervalues()))
+    seq_count = Counter()
+    if index is None:
+        index = index_sample_sheet(sample_sheet)[0]
+    index5, index3 = index
+    pool = OutputPool(out_map, max_open=max_open, buffer_size=buffer_size,
+                      max_buffered=max_buffered)
+    try:
+        reader = FastaReader(f)
+        for header, seq in reader:
+            matches5 = []
+            for L, bc_map in index5:
+                bc = bc_map.get(seq[:L])
+                if bc is not None:
+                    matches5.append(bc)
+            if not matches5:
+                continue
+            n = len(seq)
+            samples = set()
+            for L, bc_map in index3:
+                if L > n:
+                    break
+                bc3 = bc_map.get(seq[n-L:])
+                if bc3 is None:
+                    continue
+                for bc5 in matches5:
+                    sample = sample_sheet.get((bc5, bc3))
+                    if sample is not None:
+                        samples.add(sample)
+            for sample in samples:
+                pool.write(sample, ">%s\n%s\n" % (header, seq))
+                seq_count[sample] += 1
+    finally:
+        pool.close()
+    return seq_count, out_map
+
+
+def record_boundaries(fn, n_chunks):
+    """
+    Split FASTA file ``fn`` into (at most) ``n_chunks`` byte ranges.
+
+    Return a list of offsets such that each pair of consecutive
+    offsets delimits a range of whole FASTA records.
+    """
+    size = os.path.getsize(fn)
+    offsets = [0]
+    with open(fn) as f:
+        for i in xrange(1, n_chunks):
+            target = max(i * size // n_chunks, offsets[-1])
+            f.seek(target)
+            if target > 0:
+                f.readline()  # skip to the next line start
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    pos = size
+                    break
+                if line.startswith(">"):
+                    break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+    if size > offsets[-1]:
+        offsets.append(size)
+    return offsets
+
+
+def iter_range(f, start, end):
+    """
+    Iterate through the lines of ``f`` in the [start, end) byte range.
+    """
+    f.seek(start)
+    pos = start
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def demux_range(args):
+    demux_func, fn, start, end, targets, outdir, kwargs = args
+    with open(fn) as f:
+        return demux_func(
+            iter_range(f, start, end), targets, outdir=outdir, **kwargs
+            )
+
+
+def demux_fasta_parallel(fn, targets, outdir=DEFAULT_OUTPUT_DIR,
+                         processes=None, demux_func=demux_fasta, **kwargs):
+    """
+    Run ``demux_func`` (:func:`demux_fasta` or
+    :func:`demux_fasta_dual`) on chunks of FASTA file ``fn`` with a
+    pool of worker processes. ``targets`` and ``kwargs`` are passed on
+    to ``demux_func``.
+
+    Each worker writes its own output files in a temporary directory;
+    these are then concatenated in input order, so output files are
+    the same as the ones written by ``demux_func`` on the whole input.
+    """
+    if processes is None:
+        processes = mp.cpu_count()
+    offsets = record_boundaries(fn, processes)
+    if len(offsets) < 2:  # empty input
+        with open(fn) as f:
+            return demux_func(f, targets, outdir=outdir, **kwargs)
+    tmp_root = tempfile.mkdtemp(prefix=".demux_", dir=outdir)
+    try:
+        chunk_dirs = []
+        for i in xrange(len(offsets) - 1):
+            chunk_dirs.append(os.path.join(tmp_root, str(i)))
+            os.mkdir(chunk_dirs[-1])
+        tasks = [(demux_func, fn, offsets[i], offsets[i+1], targets, d,
+                  kwargs) for i, d in enumerate(chunk_dirs)]
+        pool = mp.Pool(processes)
+        try:
+            results = pool.map(demux_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        seq_count = Counter()
+        for c, _ in results:
+            seq_count.update(c)
+        out_map = {}
+        for k, path in results[0][1].iteritems():
+            bn = os.path.basename(path)
+            out_map[k] = os.path.join(outdir, bn)
+            with open(out_map[k], 'w') as outf:
+                for d in chunk_dirs:
+                    with open(os.path.join(d, bn)) as f:
+                        shutil.copyfileobj(f, outf)
+    finally:
+        shutil.rmtree(tmp_root)
     return seq_count, out_map
 
 
@@ -65,11 +437,39 @@ def make_parser():
     parser.add_argument("input", metavar="INPUT", help="FASTA file")
     parser.add_argument("barcodes", metavar="BARCODES",
                         help="barcode file (one barcode per line)")
+    parser.add_argument("--dual", action="store_true",
+                        help="BARCODES is a sample sheet with one "
+                        "(sample, 5' barcode, 3' barcode) triple per line")
     parser.add_argument("--outdir", metavar="DIR_PATH",
                         default=DEFAULT_OUTPUT_DIR, help="output dir")
+    parser.add_argument("--max-mismatches", metavar="INT", type=int,
+                        default=0, help="max mismatches in barcodes")
+    parser.add_argument("--processes", metavar="INT", type=int, default=1,
+                        help="n. of worker processes")
+    parser.add_argument("--max-open-files", metavar="INT", type=int,
+                        default=DEFAULT_MAX_OPEN,
+                        help="max n. of simultaneously open output files")
+    parser.add_argument("--buffer-size", metavar="INT", type=int,
+                        default=DEFAULT_BUFFER_SIZE,
+                        help="per-barcode write buffer size in bytes")
+    parser.add_argument("--max-buffered", metavar="INT", type=int,
+                        default=DEFAULT_MAX_BUFFERED,
+                        help="max total buffered bytes across all barcodes "
+                        "(per process): without it, buffers could take up "
+                        "to n. of barcodes * buffer size bytes")
     return parser
 
 
+def report_ambiguous(ambiguous, outf=sys.stderr, end=None):
+    by_matches = Counter(frozenset(_) for _ in ambiguous.itervalues())
+    what = "%s barcodes " % end if end else ""
+    for matches, count in sorted(by_matches.iteritems(),
+                                 key=lambda t: sorted(t[0])):
+        outf.write("WARNING: %d sequence(s) equally close to %s%s: "
+                   "discarding matching reads\n" %
+                   (count, what, ", ".join(sorted(matches))))
+
+
 def main(argv):
     parser = make_parser()
     args = parser.parse_args(argv[1:])
@@ -78,8 +478,33 @@ def main(argv):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-    barcodes = get_barcodes(args.barcodes)
-    with open(args.input) as f:
-        seq_count, out_map = demux_fasta(f, barcodes, outdir=args.outdir)
-    for bc, count in seq_count.most_common():
-        print "%s\t%d\t%s" % (bc, count, out_map[bc].name)
+    if args.dual:
+        targets = get_sample_sheet(args.barcodes)
+        index, (ambiguous5, ambiguous3) = index_sample_sheet(
+            targets, args.max_mismatches
+            )
+        report_ambiguous(ambiguous5, end="5'")
+        report_ambiguous(ambiguous3, end="3'")
+        demux_func = demux_fasta_dual
+    else:
+        targets = get_barcodes(args.barcodes)
+        index, ambiguous = index_barcodes(targets, args.max_mismatches)
+        report_ambiguous(ambiguous)
+        demux_func = demux_fasta
+    kwargs = {
+        "outdir": args.outdir,
+        "index": index,
+        "max_open": args.max_open_files,
+        "buffer_size": args.buffer_size,
+        "max_buffered": args.max_buffered,
+        }
+    if args.processes > 1:
+        seq_count, out_map = demux_fasta_parallel(
+            args.input, targets, processes=args.processes,
+            demux_func=demux_func, **kwargs
+            )
+    else:
+        with open(args.input) as f:
+            seq_count, out_map = demux_func(f, targets, **kwargs)
+    for k, count in seq_count.most_common():
+        print "%s\t%d\t%s" % (k, count, out_map[k])
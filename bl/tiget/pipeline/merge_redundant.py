@@ -23,9 +23,12 @@
 Merge redundant integration loci.
 """
 
-import sys, argparse, csv
+import sys, os, argparse, tempfile, shutil, heapq, json, hashlib
+import multiprocessing as mp
 from collections import Counter
 
+import numpy as np
+
 
 CHR_TAG = "s_id"
 LOCUS_TAG = "s_start"
@@ -44,6 +47,10 @@ HEADER = [
   "score",
   ]
 
+DEFAULT_BUFFER_SIZE = 10000000
+RUN_BLOCK_SIZE = 65536
+SEGMENT_SIZE = 65536
+
 HEADER_HELP = """
 Header fields for the input file, separated by commas. Iff this is set
 to 'auto', header fields will be looked for in the first row.
@@ -63,46 +70,499 @@ def chrom_sorted(chrom_list):
   return map(str, numbers) + letters
 
 
+def chrom_key(chrom):
+  """
+  Sort key consistent with :func:`chrom_sorted`.
+  """
+  try:
+    return 0, int(chrom), ""
+  except ValueError:
+    return 1, 0, chrom
+
+
+def column_indices(fieldnames, *tags):
+  """
+  Return the positions of ``tags`` in ``fieldnames``.
+  """
+  indices = []
+  for t in tags:
+    try:
+      indices.append(fieldnames.index(t))
+    except ValueError:
+      raise RuntimeError("field %r not found in header %r" % (t, fieldnames))
+  return indices
+
+
+def iter_loci(fn, delimiter="\t", header=None,
+              chr_tag=CHR_TAG, locus_tag=LOCUS_TAG):
+  """
+  Iterate through the (chromosome, locus) pairs in input file ``fn``.
+
+  Only the chromosome and locus columns are read: their positions are
+  looked up once in the header, and each line is split no further
+  than the rightmost of the two.
+  """
+  with open(fn) as f:
+    print "reading input from %s" % fn
+    if header is None:
+      header = f.readline().rstrip("\r\n").split(delimiter)
+    indices = None
+    for line in f:
+      line = line.rstrip("\r\n")
+      if not line:
+        continue
+      if indices is None:
+        chr_idx, locus_idx = indices = column_indices(
+          header, chr_tag, locus_tag
+          )
+        maxsplit = max(indices) + 1
+      fields = line.split(delimiter, maxsplit)
+      yield fields[chr_idx], int(fields[locus_idx])
+
+
 def first_pass(fn, delimiter="\t", header=None,
                chr_tag=CHR_TAG, locus_tag=LOCUS_TAG):
   """
   Split data by chromosome and merge identical loci.
   """
   unique_locs = {}
-  with open(fn) as f:
-    print "reading input from %s" % fn
-    reader = csv.DictReader(f, fieldnames=header, delimiter=delimiter)
-    for r in reader:
-      try:
-        chrom, locus = r[chr_tag], int(r[locus_tag])
-      except KeyError as e:
-        raise RuntimeError(
-          "field %s not found in header %r" % (e, reader.fieldnames)
-          )
-      unique_locs.setdefault(chrom, Counter())[locus] += 1
+  for chrom, locus in iter_loci(fn, delimiter, header, chr_tag, locus_tag):
+    try:
+      unique_locs[chrom][locus] += 1
+    except KeyError:
+      unique_locs[chrom] = Counter({locus: 1})
   return unique_locs
 
 
+def spill(unique_locs, runs, tmpdir):
+  """
+  Write each chromosome's locus counts to a new sorted run file.
+  """
+  for chrom, counter in unique_locs.iteritems():
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+    os.close(fd)
+    loci, counts = counter_to_arrays(counter)
+    np.column_stack((loci, counts)).tofile(path)
+    runs.setdefault(chrom, []).append(path)
+
+
+def first_pass_external(fn, tmpdir, buffer_size=DEFAULT_BUFFER_SIZE,
+                        delimiter="\t", header=None,
+                        chr_tag=CHR_TAG, locus_tag=LOCUS_TAG):
+  """
+  Like :func:`first_pass`, but keep at most ``buffer_size`` distinct
+  loci in memory: when the limit is reached, their counts are written
+  to per-chromosome sorted runs in ``tmpdir``.
+
+  Return a dict that maps chromosomes to lists of run file paths, to
+  be merged with :func:`iter_sorted_counts`.
+  """
+  runs, unique_locs, n_loci = {}, {}, 0
+  for chrom, locus in iter_loci(fn, delimiter, header, chr_tag, locus_tag):
+    try:
+      counter = unique_locs[chrom]
+    except KeyError:
+      counter = unique_locs[chrom] = Counter()
+    if locus not in counter:
+      n_loci += 1
+    counter[locus] += 1
+    if n_loci >= buffer_size:
+      spill(unique_locs, runs, tmpdir)
+      unique_locs, n_loci = {}, 0
+  spill(unique_locs, runs, tmpdir)
+  return runs
+
+
+def iter_run(path, block_size=RUN_BLOCK_SIZE):
+  with open(path, "rb") as f:
+    while True:
+      a = np.fromfile(f, dtype=np.int64, count=2*block_size)
+      if not a.size:
+        break
+      for pair in a.reshape(-1, 2).tolist():
+        yield pair
+
+
+def iter_sorted_counts(paths):
+  """
+  Merge sorted runs, yielding [locus, count] pairs sorted by locus,
+  where counts for the same locus are summed up.
+  """
+  current = None
+  for locus, count in heapq.merge(*[iter_run(p) for p in paths]):
+    if current is not None and locus == current[0]:
+      current[1] += count
+      continue
+    if current is not None:
+      yield current
+    current = [locus, count]
+  if current is not None:
+    yield current
+
+
+def counter_to_arrays(counter):
+  """
+  Convert a locus counter into parallel locus and count arrays,
+  sorted by locus.
+  """
+  loci = np.fromiter(counter.iterkeys(), dtype=np.int64, count=len(counter))
+  counts = np.fromiter(counter.itervalues(), dtype=np.int64,
+                       count=len(counter))
+  order = loci.argsort()
+  return loci[order], counts[order]
+
+
+def iter_clusters(sorted_items, window_size):
+  """
+  Group (key, locus, data) triples, sorted by (key, locus), into
+  clusters of redundant loci.
+
+  A locus is merged into the current cluster if it has the same key
+  and it's within ``window_size`` of both the previous locus and the
+  cluster's first locus. Yield (key, first_locus, data_list) tuples.
+  """
+  current, previous = None, None
+  for key, locus, data in sorted_items:
+    if (current is not None and key == current[0] and
+        locus - previous <= window_size and
+        locus - current[1] <= window_size):
+      current[2].append(data)
+    else:
+      if current is not None:
+        yield current
+      current = key, locus, [data]
+    previous = locus
+  if current is not None:
+    yield current
+
+
+def merge_loci(loci, counts, window_size):
+  """
+  Merge redundant integration loci for a single chromosome.
+
+  loci, counts: parallel arrays, sorted by locus.
+
+  Loci are grouped as in :func:`iter_clusters`, but the two window
+  conditions are applied separately. The gap to the previous locus is
+  checked for all loci at once, with ``diff``, splitting them into
+  runs with no gaps wider than ``window_size``. The distance from the
+  cluster's first locus can only split runs that span more than
+  ``window_size``: these (usually rare) runs are passed, one at a
+  time, to :func:`iter_clusters`, which applies both conditions.
+
+  Return parallel arrays of cluster start loci and total counts.
+  """
+  loci = np.asarray(loci)
+  counts = np.asarray(counts)
+  n = len(loci)
+  if n == 0:
+    return loci[:0], counts[:0]
+  starts = np.empty(n, dtype=bool)
+  starts[0] = True
+  np.greater(np.diff(loci), window_size, out=starts[1:])
+  run_starts = np.flatnonzero(starts)
+  run_ends = np.append(run_starts[1:], n)
+  wide = loci[run_ends-1] - loci[run_starts] > window_size
+  for b, e in zip(run_starts[wide], run_ends[wide]):
+    items = ((None, locus, i) for i, locus in enumerate(loci[b:e].tolist()))
+    for _, _, idx in iter_clusters(items, window_size):
+      starts[b+idx[0]] = True
+  idx = np.flatnonzero(starts)
+  return loci[idx], np.add.reduceat(counts, idx)
+
+
 def merge_single_chrom(sorted_data, window_size):
   """
   Merge redundant integration loci for a single chromosome.
 
   sorted_data: list of (locus, count) pairs, sorted by locus.
+
+  Return a list of [locus, count] pairs: see :func:`merge_loci`.
   """
-  merged = []
-  current = None
-  for i, (locus, count) in enumerate(sorted_data):
-    if i == 0:
-      current = [locus, count]
+  if not sorted_data:
+    return []
+  loci, counts = np.array(sorted_data, dtype=np.int64).T
+  merged_loci, merged_counts = merge_loci(loci, counts, window_size)
+  return np.column_stack((merged_loci, merged_counts)).tolist()
+
+
+def iter_merged(sorted_data, window_size):
+  """
+  Streaming version of :func:`merge_single_chrom`: sorted_data can be
+  any iterable of (locus, count) pairs sorted by locus.
+  """
+  items = ((None, locus, count) for locus, count in sorted_data)
+  for _, locus, counts in iter_clusters(items, window_size):
+    yield [locus, sum(counts)]
+
+
+def iter_sites(fn, sample, delimiter="\t"):
+  """
+  Iterate through the int. sites in merged output ``fn``, yielding
+  (chrom_key, locus, sample, count, chrom) tuples.
+  """
+  with open(fn) as f:
+    for line in f:
+      line = line.rstrip("\r\n")
+      if not line:
+        continue
+      chrom, locus, count = line.split(delimiter)
+      yield chrom_key(chrom), int(locus), sample, int(count), chrom
+
+
+def iter_shared(fns, window_size, delimiter="\t"):
+  """
+  Find int. sites shared by multiple samples.
+
+  fns: merged outputs (as written by this module), one per sample.
+
+  All sites are visited in a single sorted sweep (a k-way merge of the
+  inputs) and grouped by :func:`iter_clusters`. Yield [chrom, locus,
+  counts] lists, where locus is the group's first locus and counts
+  maps sample indices (positions in ``fns``) to counts.
+  """
+  streams = [iter_sites(fn, i, delimiter) for i, fn in enumerate(fns)]
+  items = ((key, locus, (i, count, chrom))
+           for key, locus, i, count, chrom in heapq.merge(*streams))
+  for _, locus, sites in iter_clusters(items, window_size):
+    counts = {}
+    for i, count, chrom in sites:
+      counts[i] = counts.get(i, 0) + count
+    yield [chrom, locus, counts]
+
+
+def write_shared(fns, window_size, delimiter, fo, sparse=False,
+                 min_samples=1):
+  """
+  Write the locus x sample count matrix for merged outputs ``fns``
+  (see :func:`iter_shared`), skipping sites found in less than
+  ``min_samples`` samples.
+
+  Dense rows are chrom, locus and one count per sample, after a header
+  row with sample names; sparse rows are chrom, locus, sample, count,
+  for nonzero counts only.
+  """
+  names = [os.path.splitext(os.path.basename(fn))[0] for fn in fns]
+  if not sparse:
+    fo.write(delimiter.join(["chrom", "locus"] + names) + "\n")
+  for chrom, locus, counts in iter_shared(fns, window_size, delimiter):
+    if len(counts) < min_samples:
       continue
-    if (locus - sorted_data[i-1][0] <= window_size and
-        locus - current[0] <= window_size):
-      current[1] += count
+    if sparse:
+      for i in sorted(counts):
+        fo.write(delimiter.join([chrom, str(locus), names[i],
+                                 str(counts[i])]) + "\n")
+    else:
+      fo.write(delimiter.join(
+        [chrom, str(locus)] + [str(counts.get(i, 0)) for i in xrange(len(fns))]
+        ) + "\n")
+
+
+def update_merged(loci, counts, merged_loci, merged_counts,
+                  new_loci, new_counts, window_size):
+  """
+  Add new locus counts to already merged data for a single chromosome.
+
+  loci, counts: sorted unique loci and their counts, as merged so far.
+  merged_loci, merged_counts: the corresponding :func:`merge_loci`
+    output. new_loci, new_counts: sorted unique new loci and counts.
+
+  Since clusters never span a gap wider than ``window_size``, only
+  runs of loci (with no such gaps) that include a new locus need to
+  be merged again: clusters from all other runs are kept as they are.
+  The input arrays are still copied in full: :class:`LocusStore` keeps
+  them small by only passing the segments close to new loci.
+
+  Return updated (loci, counts, merged_loci, merged_counts).
+  """
+  pos = loci.searchsorted(new_loci)
+  found = pos < len(loci)
+  found[found] = loci[pos[found]] == new_loci[found]
+  counts = np.array(counts)
+  counts[pos[found]] += new_counts[found]
+  loci = np.insert(loci, pos[~found], new_loci[~found])
+  counts = np.insert(counts, pos[~found], new_counts[~found])
+  run_ids = np.cumsum(np.concatenate(([1], np.diff(loci) > window_size)))
+  affected = np.unique(run_ids[loci.searchsorted(new_loci)])
+  keep = ~np.in1d(run_ids[loci.searchsorted(merged_loci)], affected)
+  mask = np.in1d(run_ids, affected)
+  # affected runs are still separated by wide gaps, so they can be
+  # merged all at once
+  m_loci, m_counts = merge_loci(loci[mask], counts[mask], window_size)
+  merged_loci = np.concatenate((merged_loci[keep], m_loci))
+  merged_counts = np.concatenate((merged_counts[keep], m_counts))
+  order = merged_loci.argsort(kind="mergesort")
+  return loci, counts, merged_loci[order], merged_counts[order]
+
+
+class LocusStore(object):
+
+  META_FN = "meta.json"
+  KINDS = "loci", "merged"
+
+  def __init__(self, path, window_size, segment_size=SEGMENT_SIZE):
+    """
+    Persistent per-cohort store of locus counts and merged loci.
+
+    For each chromosome, sorted unique loci with their counts are
+    split into segments of about ``segment_size`` loci, cut only at
+    gaps wider than ``window_size`` so that no cluster spans two of
+    them. Each segment keeps its loci and merged loci as (n, 2) arrays
+    in .npy files, and covers all positions from its first locus to
+    the next segment's first locus. Data from new samples is added by
+    :meth:`update`, which only loads, merges again (see
+    :func:`update_merged`) and rewrites the segments whose range
+    includes a new locus or is within ``window_size`` of it: its cost
+    grows with the amount of new data, not with the size of the
+    cohort.
+
+    Updates are not visible until :meth:`commit` is called: new
+    segments are written to fresh files, and the switch to them
+    happens when the metadata file, which lists all segments, is
+    atomically replaced. If the process dies before that, the store
+    is left in its previous state. The metadata also records the MD5
+    checksums of all inputs, so that the same sample cannot be added
+    twice.
+
+    A store is tied to the window size it was created with.
+    """
+    self.path = path
+    self.window_size = window_size
+    self.segment_size = segment_size
+    meta_fn = os.path.join(path, self.META_FN)
+    if os.path.exists(meta_fn):
+      with open(meta_fn) as f:
+        meta = json.load(f)
+      if meta["window_size"] != window_size:
+        raise ValueError("%r was built with window size %d" % (
+          path, meta["window_size"]
+          ))
+      self.next_id = meta["next_id"]
+      self.chroms = dict((str(k), [tuple(_) for _ in v])
+                         for k, v in meta["chroms"].iteritems())
+      self.inputs = set(meta["inputs"])
+    else:
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      self.next_id = 0
+      self.chroms = {}  # chrom -> [(first locus, segment id), ...]
+      self.inputs = set()
+
+  def __path(self, seg_id, kind):
+    return os.path.join(self.path, "%d.%s.npy" % (seg_id, kind))
+
+  def __load(self, segments, kind):
+    if not segments:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    a = np.concatenate([np.load(self.__path(seg_id, kind), mmap_mode="r")
+                        for _, seg_id in segments])
+    return a[:, 0], a[:, 1]
+
+  def load(self, chrom, kind="merged"):
+    """
+    Get (loci, counts) arrays for ``chrom``. ``kind`` is either
+    "merged" or "loci" (unique loci before merging).
+    """
+    return self.__load(self.chroms.get(chrom, []), kind)
+
+  def __split(self, loci):
+    # cut points at gaps wider than the window, leaving at least
+    # segment_size loci on both sides of each cut
+    n, size = len(loci), self.segment_size
+    gaps = np.flatnonzero(np.diff(loci) > self.window_size) + 1
+    cuts, prev = [], 0
+    while True:
+      j = gaps.searchsorted(prev + size)
+      if j >= len(gaps) or n - gaps[j] < size:
+        break
+      prev = gaps[j]
+      cuts.append(prev)
+    return cuts
+
+  def __write_segments(self, loci, counts, merged_loci, merged_counts):
+    cuts = self.__split(loci)
+    bounds = zip([0] + cuts, cuts + [len(loci)])
+    m_cuts = merged_loci.searchsorted(loci[cuts]).tolist()
+    m_bounds = zip([0] + m_cuts, m_cuts + [len(merged_loci)])
+    segments = []
+    for (b, e), (mb, me) in zip(bounds, m_bounds):
+      seg_id, self.next_id = self.next_id, self.next_id + 1
+      data = {
+        "loci": (loci[b:e], counts[b:e]),
+        "merged": (merged_loci[mb:me], merged_counts[mb:me]),
+        }
+      for kind in self.KINDS:
+        with open(self.__path(seg_id, kind), "wb") as f:
+          np.save(f, np.column_stack(data[kind]))
+          f.flush()
+          os.fsync(f.fileno())
+      segments.append((int(loci[b]), seg_id))
+    return segments
+
+  def update(self, chrom, new_loci, new_counts):
+    """
+    Add sorted unique ``new_loci`` with their counts to ``chrom``.
+    """
+    segments = self.chroms.get(chrom, [])
+    if not segments:
+      runs = [(0, -1, 0, len(new_loci))]
     else:
-      merged.append(current)
-      current = [locus, count]
-  merged.append(current)
-  return merged
+      starts = np.array([lo for lo, _ in segments], dtype=np.int64)
+      owner = (starts.searchsorted(new_loci, side="right") - 1).clip(0)
+      reach = (starts.searchsorted(new_loci + self.window_size,
+                                   side="right") - 1).clip(0)
+      # segments from owner to reach are affected: group them into runs
+      # of consecutive segments, which can be updated separately
+      cover = np.zeros(len(segments) + 1, dtype=np.int64)
+      np.add.at(cover, owner, 1)
+      np.add.at(cover, reach + 1, -1)
+      affected = np.flatnonzero(np.cumsum(cover)[:-1])
+      breaks = np.flatnonzero(np.diff(affected) > 1) + 1
+      runs = []
+      for r in np.split(affected, breaks):
+        b = owner.searchsorted(r[0])
+        e = owner.searchsorted(r[-1], side="right")
+        runs.append((r[0], r[-1], b, e))
+    for first, last, b, e in reversed(runs):
+      run = segments[first:last+1]
+      data = self.__load(run, "loci") + self.__load(run, "merged")
+      updated = update_merged(
+        *(data + (new_loci[b:e], new_counts[b:e], self.window_size))
+        )
+      segments = (segments[:first] + self.__write_segments(*updated) +
+                  segments[last+1:])
+    self.chroms[chrom] = segments
+
+  def commit(self, input_checksum):
+    """
+    Make all updates since the last commit visible, recording
+    ``input_checksum`` (see :func:`checksum`) as added.
+
+    Raise ValueError if that input is already in the store.
+    """
+    if input_checksum in self.inputs:
+      raise ValueError("input with checksum %s already added to %r" % (
+        input_checksum, self.path
+        ))
+    self.inputs.add(input_checksum)
+    meta_fn = os.path.join(self.path, self.META_FN)
+    with open(meta_fn + ".tmp", "w") as f:
+      json.dump({
+        "window_size": self.window_size,
+        "next_id": self.next_id,
+        "chroms": self.chroms,
+        "inputs": sorted(self.inputs),
+        }, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(meta_fn + ".tmp", meta_fn)
+    # drop replaced files, as well as those left by interrupted updates
+    live = set(os.path.basename(self.__path(seg_id, k))
+               for segments in self.chroms.itervalues()
+               for _, seg_id in segments for k in self.KINDS)
+    for fn in os.listdir(self.path):
+      if fn.endswith(".npy") and fn not in live:
+        os.remove(os.path.join(self.path, fn))
 
 
 def make_parser():
@@ -110,7 +570,9 @@ def make_parser():
     description=__doc__.strip(),
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-  parser.add_argument("input", metavar="INPUT", help="BLAST tabular results")
+  parser.add_argument("input", metavar="INPUT", nargs="+",
+                      help="BLAST tabular results (with --shared: merged "
+                      "int. sites, one file per sample)")
   parser.add_argument("output", metavar="OUTPUT", help="merged int. sites")
   parser.add_argument("-d", "--delimiter", metavar="STRING",
                       help="field delimiter", default="\t")
@@ -124,40 +586,222 @@ def make_parser():
                       help="chromosome header tag", default=CHR_TAG)
   parser.add_argument("--locus-tag", metavar="STRING",
                       help="integration locus header tag", default=LOCUS_TAG)
+  parser.add_argument("--external", action="store_true",
+                      help="out-of-core mode, for inputs larger than RAM")
+  parser.add_argument("--buffer-size", metavar="INT", type=int,
+                      default=DEFAULT_BUFFER_SIZE,
+                      help="max n. of distinct loci kept in memory "
+                      "(external mode)")
+  parser.add_argument("--temp-dir", metavar="DIR",
+                      help="directory for temporary files")
+  parser.add_argument("--processes", metavar="INT", type=int, default=1,
+                      help="n. of worker processes (one chromosome each)")
+  parser.add_argument("--store", metavar="DIR",
+                      help="incremental mode: add input loci to this "
+                      "per-cohort store (created if needed) and write "
+                      "merged loci for the whole cohort. Inputs already "
+                      "in the store are rejected. Updating the store "
+                      "takes time proportional to the new data, but "
+                      "OUTPUT is always written in full")
+  parser.add_argument("--shared", action="store_true",
+                      help="find int. sites shared by the input samples, "
+                      "writing a locus x sample count matrix")
+  parser.add_argument("--sparse", action="store_true",
+                      help="write the shared int. sites matrix in sparse "
+                      "(chrom, locus, sample, count) form")
+  parser.add_argument("--min-samples", metavar="INT", type=int, default=1,
+                      help="only write shared int. sites found in at least "
+                      "this many samples")
   return parser
 
 
+def write_rows(f, chrom, data, delimiter):
+  for locus, count in data:
+    f.write(delimiter.join([chrom, str(locus), str(count)])+"\n")
+
+
+def tee_rows(f, chrom, data, delimiter):
+  for pair in data:
+    write_rows(f, chrom, [pair], delimiter)
+    yield pair
+
+
+def merge_chrom(chrom, data, window_size, delimiter, fo, fdump=None):
+  """
+  Merge loci for a single chromosome and write them to ``fo``.
+
+  data: either a Counter of loci (in-memory mode) or a list of run
+    paths (external mode). If ``fdump`` is not None, write
+    intermediate data (sorted locus counts) to it.
+  """
+  if isinstance(data, Counter):
+    loci, counts = counter_to_arrays(data)
+    if fdump is not None:
+      write_rows(fdump, chrom, zip(loci.tolist(), counts.tolist()),
+                 delimiter)
+    merged = zip(*[_.tolist() for _ in merge_loci(loci, counts, window_size)])
+  else:
+    data = iter_sorted_counts(data)
+    if fdump is not None:
+      data = tee_rows(fdump, chrom, data, delimiter)
+    merged = iter_merged(data, window_size)
+  write_rows(fo, chrom, merged, delimiter)
+
+
+# Set by merge_parallel before the pool is created, so that forked
+# workers inherit it: tasks only need to carry the chromosome name.
+_CHROM_DATA = {}
+
+
+def merge_chrom_worker(args):
+  chrom, window_size, delimiter, out_fn, dump_fn = args
+  data = _CHROM_DATA[chrom]
+  fdump = None if dump_fn is None else open(dump_fn, "w")
+  try:
+    with open(out_fn, "w") as fo:
+      merge_chrom(chrom, data, window_size, delimiter, fo, fdump)
+  finally:
+    if fdump is not None:
+      fdump.close()
+
+
+def data_size(data):
+  if isinstance(data, Counter):
+    return len(data)
+  return sum(os.path.getsize(_) for _ in data)
+
+
+def merge_parallel(chrom_data, window_size, delimiter, fo, fdump, tmpdir,
+                   processes):
+  """
+  Run :func:`merge_chrom` for each (chrom, data) pair in a pool of
+  worker processes, largest chromosomes first.
+
+  Each worker writes to its own temporary files, which are then
+  appended to ``fo`` (and ``fdump``) in ``chrom_data`` order. Loci
+  are not sent to the workers: they are read from a module-level
+  reference inherited at fork time.
+  """
+  global _CHROM_DATA
+  tasks, sizes = [], []
+  for i, (chrom, data) in enumerate(chrom_data):
+    out_fn = os.path.join(tmpdir, "%d.out" % i)
+    dump_fn = None if fdump is None else os.path.join(tmpdir, "%d.dump" % i)
+    tasks.append((chrom, window_size, delimiter, out_fn, dump_fn))
+    sizes.append(data_size(data))
+  _CHROM_DATA = dict(chrom_data)
+  pool = mp.Pool(processes)
+  try:
+    results = [None] * len(tasks)
+    for i in sorted(xrange(len(tasks)), reverse=True, key=sizes.__getitem__):
+      results[i] = pool.apply_async(merge_chrom_worker, (tasks[i],))
+    pool.close()
+    for r, t in zip(results, tasks):
+      r.get()
+      for fn, f in (t[-2], fo), (t[-1], fdump):
+        if fn is not None:
+          with open(fn) as fi:
+            shutil.copyfileobj(fi, f)
+          os.remove(fn)
+  finally:
+    pool.terminate()
+    pool.join()
+    _CHROM_DATA = {}
+
+
+def checksum(fn, block_size=RUN_BLOCK_SIZE):
+  md5 = hashlib.md5()
+  with open(fn, "rb") as f:
+    while 1:
+      s = f.read(block_size)
+      if not s:
+        break
+      md5.update(s)
+  return md5.hexdigest()
+
+
+def merge_with_store(store, chrom_map, input_checksum, delimiter, fo,
+                     fdump=None):
+  """
+  Add loci in ``chrom_map`` (see :func:`first_pass`) to ``store``,
+  commit them as coming from the input with ``input_checksum``, and
+  write the updated content of the whole store.
+  """
+  for chrom, counter in chrom_map.iteritems():
+    store.update(chrom, *counter_to_arrays(counter))
+  store.commit(input_checksum)
+  for chrom in chrom_sorted(store.chroms.keys()):
+    if fdump is not None:
+      write_rows(fdump, chrom,
+                 zip(*[_.tolist() for _ in store.load(chrom, "loci")]),
+                 delimiter)
+    write_rows(fo, chrom, zip(*[_.tolist() for _ in store.load(chrom)]),
+               delimiter)
+
+
 def main(argv):
   parser = make_parser()
   args = parser.parse_args(argv[1:])
+  if args.shared:
+    with open(args.output, "w") as fo:
+      write_shared(args.input, args.window_size, args.delimiter, fo,
+                   args.sparse, args.min_samples)
+    print "wrote output to %s" % args.output
+    return
+  if len(args.input) > 1:
+    parser.error("multiple inputs are only allowed with --shared")
+  args.input = args.input[0]
+  if args.store and args.external:
+    parser.error("--store and --external are mutually exclusive")
+  if args.store and args.processes > 1:
+    parser.error("--store does not support --processes")
   if args.header == 'auto':
     args.header = None
   else:
     args.header = args.header.split(",")
-  unique_locs = first_pass(
-    args.input,
-    delimiter=args.delimiter,
-    header=args.header,
-    chr_tag=args.chr_tag,
-    locus_tag=args.locus_tag
-    )
-  if args.dump_intermediate:
-    fdump = open("%s.intermediate" % args.output, "w")
-  with open(args.output, "w") as fo:
-    for chrom in chrom_sorted(unique_locs.keys()):
-      data = unique_locs[chrom].items()
-      data.sort()
-      if args.dump_intermediate:
-        for locus, count in data:
-          fdump.write(args.delimiter.join(
-            [chrom, str(locus), str(count)]
-            )+"\n")
-      merged = merge_single_chrom(data, args.window_size)
-      for locus, count in merged:
-        fo.write(args.delimiter.join([chrom, str(locus), str(count)])+"\n")
-    print "wrote output to %s" % args.output
+  kwargs = {
+    "delimiter": args.delimiter,
+    "header": args.header,
+    "chr_tag": args.chr_tag,
+    "locus_tag": args.locus_tag,
+    }
+  tmpdir = None
+  store = input_checksum = None
+  if args.store:
+    store = LocusStore(args.store, args.window_size)
+    input_checksum = checksum(args.input)
+    if input_checksum in store.inputs:
+      parser.error("%s is already in %s" % (args.input, args.store))
+  if args.external or args.processes > 1:
+    tmpdir = tempfile.mkdtemp(prefix="merge_redundant_", dir=args.temp_dir)
+  try:
+    if args.external:
+      chrom_map = first_pass_external(args.input, tmpdir, args.buffer_size,
+                                      **kwargs)
+    else:
+      chrom_map = first_pass(args.input, **kwargs)
+    chrom_data = [(c, chrom_map[c]) for c in chrom_sorted(chrom_map.keys())]
+    fdump = None
     if args.dump_intermediate:
-      print " * DEBUG: wrote intermediate data to %s" % fdump.name
+      fdump = open("%s.intermediate" % args.output, "w")
+    with open(args.output, "w") as fo:
+      if store is not None:
+        merge_with_store(store, chrom_map, input_checksum, args.delimiter,
+                         fo, fdump)
+      elif args.processes > 1:
+        merge_parallel(chrom_data, args.window_size, args.delimiter, fo,
+                       fdump, tmpdir, args.processes)
+      else:
+        for chrom, data in chrom_data:
+          merge_chrom(chrom, data, args.window_size, args.delimiter, fo,
+                      fdump)
+      print "wrote output to %s" % args.output
+      if args.dump_intermediate:
+        fdump.close()
+        print " * DEBUG: wrote intermediate data to %s" % fdump.name
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir)
 
 
 if __name__ == "__main__":
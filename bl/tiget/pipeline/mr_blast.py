@@ -45,6 +45,16 @@ blast_db: mm9
 Note that option names are command line long option names with dashes
 replaced by underscores. A command line option overrides its
 corresponding configuration file option.
+
+In addition to the unambiguous, repeat, no_hit and all_hits.tsv
+output files, the program writes top_hits.tsv, which holds the best
+hits for each query (see --summary-hits) followed by the query
+length. This can be fed to the reclassify tool to try different
+repeat thresholds without running BLAST again.
+
+With --merge, redundant integration loci are also merged on Hadoop
+(one reducer per chromosome group) and written to merged.tsv, in the
+same format as merge_redundant's output.
 """
 
 import sys, os, logging, optparse, ConfigParser, uuid, hashlib
@@ -52,6 +62,7 @@ import subprocess as sp
 
 import pydoop.hdfs as hdfs
 import bl.tiget.mr.blast.al_type as al_type
+from bl.tiget.pipeline.merge_redundant import chrom_sorted
 
 
 LOG_FORMAT = '%(asctime)s|%(levelname)-8s|%(message)s'
@@ -59,16 +70,20 @@ LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
 LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
 CONFIG_FILE = "tiget_blast.cfg"
+SUMMARY_FN = "top_hits.tsv"
+MERGED_FN = "merged.tsv"
 BUFSIZE = 1024 * os.sysconf("SC_PAGE_SIZE")
 
 DEFAULTS = {
   "log_level": "WARNING",
   "out_prefix": "",
+  "summary_hits": 2,
   "disable_guardian": False,
   #--
   "hadoop_home": os.getenv("HADOOP_HOME", "/opt/hadoop"),
   "f2t_mappers": 1,
   "blast_mappers": 1,
+  "merge_reducers": 1,
   #--
   "blastall": "/usr/bin/blastall",
   "formatdb": "/usr/bin/formatdb",
@@ -84,6 +99,8 @@ DEFAULTS = {
   "tiget_homology_percent": 95.0,
   "tiget_min_al2seq_percent": 15.0,
   "tiget_min_score_diff": 20.0,
+  "merge": False,
+  "merge_window_size": 3,
 }
 
 F2T_BASE_MR_OPT = {
@@ -105,6 +122,14 @@ BLAST_BASE_MR_OPT = {
   "bl.mr.log.level": DEFAULTS["log_level"],
   }
 
+MERGE_BASE_MR_OPT = {
+  "mapred.job.name": "tiget_merge",
+  "hadoop.pipes.java.recordreader": "true",
+  "hadoop.pipes.java.recordwriter": "true",
+  "mapred.reduce.tasks": str(DEFAULTS["merge_reducers"]),
+  "bl.mr.log.level": DEFAULTS["log_level"],
+  }
+
 
 class RandomStringGenerator(object):
 
@@ -179,8 +204,13 @@ def make_parser():
                     help="MapReduce out/err dump file [stderr]")
   parser.add_option("--out-prefix", type="str", metavar="STRING",
                     help="prefix for output files ['%default']")
+  parser.add_option("--summary-hits", type="int", metavar="INT",
+                    help="n. top hits per query in the summary, "
+                    "at least 2 [%default]")
   parser.add_option("--disable-guardian", action="store_true",
                     help="disable guardian for BLAST processes [False]")
+  parser.add_option("--merge", action="store_true",
+                    help="also merge redundant int. loci on Hadoop [False]")
   config = ConfigParser.SafeConfigParser(DEFAULTS)
   config.read(CONFIG_FILE)
   defaults = config.defaults()
@@ -188,6 +218,10 @@ def make_parser():
     defaults["blast_filters"] = config.getboolean("DEFAULT", "blast_filters")
   except ValueError:
     defaults["blast_filters"] = False
+  try:
+    defaults["merge"] = config.getboolean("DEFAULT", "merge")
+  except ValueError:
+    defaults["merge"] = False
   try:
     defaults["disable_guardian"] = config.getboolean(
       "DEFAULT", "disable_guardian"
@@ -210,6 +244,8 @@ def add_hadoop_optgroup(parser):
                       help="n. mappers for fasta2tab [%default]")
   optgroup.add_option("--blast-mappers", type="int", metavar="INT",
                       help="n. mappers for blast [%default]")
+  optgroup.add_option("--merge-reducers", type="int", metavar="INT",
+                      help="n. reducers for merge [%default]")
   parser.add_option_group(optgroup)
 
 
@@ -249,6 +285,9 @@ def add_tiget_optgroup(parser):
   optgroup.add_option("-z", "--tiget-min-score-diff", type="float",
                       metavar="FLOAT",
                       help="min S1-S2 value for unique hits [%default]")
+  optgroup.add_option("-W", "--merge-window-size", type="int",
+                      metavar="INT",
+                      help="window size for merging int. loci [%default]")
   parser.add_option_group(optgroup)
 
 
@@ -279,6 +318,12 @@ def update_tiget_options(mr_opt, opt):
   mr_opt["bl.mr.seq.tiget.min.score.diff"] = opt.tiget_min_score_diff
 
 
+def update_merge_options(mr_opt, opt):
+  mr_opt["mapred.reduce.tasks"] = opt.merge_reducers
+  mr_opt["bl.mr.tiget.merge.window.size"] = opt.merge_window_size
+  mr_opt["bl.mr.log.level"] = opt.log_level_str
+
+
 class Runner(object):
 
   def __init__(self, fs, lfs, logger):
@@ -333,9 +378,41 @@ class Runner(object):
       ), opt)
     return output_hdfs
   
+  def run_merge(self, input_hdfs, opt):
+    output_hdfs, merge_launcher_hdfs = [rnd_str() for _ in xrange(2)]
+    with self.fs.open_file(merge_launcher_hdfs, "w") as outf:
+      write_launcher(outf, "bl.tiget.mr.merge")
+    mr_opt = {}
+    mr_opt.update(MERGE_BASE_MR_OPT)
+    update_merge_options(mr_opt, opt)
+    d_options = build_d_options(mr_opt)
+    self.logger.info("running merge, launcher='%s'" % merge_launcher_hdfs)
+    hadoop_pipes("%s -program %s -input %s -output %s" % (
+      d_options, merge_launcher_hdfs, input_hdfs, output_hdfs
+      ), opt)
+    return output_hdfs
+
+  def list_parts(self, output_hdfs):
+    return [r['name'] for r in self.fs.list_directory(output_hdfs)
+            if r['name'].rsplit("/", 1)[1].startswith('part')]
+
+  def collect_merged(self, output_hdfs, opt):
+    """
+    Write merge job output to a single file, sorting chromosomes
+    as merge_redundant does (each chromosome is in a single block).
+    """
+    blocks = {}
+    for path in self.list_parts(output_hdfs):
+      with self.fs.open_file(path) as f:
+        for line in f:
+          if line.strip():
+            blocks.setdefault(line.split("\t", 1)[0], []).append(line)
+    with open(opt.out_prefix+MERGED_FN, "w") as fo:
+      for chrom in chrom_sorted(blocks.keys()):
+        fo.writelines(blocks[chrom])
+
   def collect_output(self, output_hdfs, opt):
-    ls = [r['name'] for r in self.fs.list_directory(output_hdfs)
-          if r['name'].rsplit("/", 1)[1].startswith('part')]
+    ls = self.list_parts(output_hdfs)
     if os.path.sep in opt.out_prefix:
       os.makedirs(os.path.dirname(opt.out_prefix))
     output_filenames = {
@@ -346,6 +423,7 @@ class Runner(object):
     output_files = dict((k, open(opt.out_prefix+fn, "w"))
                         for k, fn in output_filenames.iteritems())
     blast_output_file = open(opt.out_prefix+"all_hits.tsv", "w")
+    summary_file = open(opt.out_prefix+SUMMARY_FN, "w")
     for i, path in enumerate(ls):
       self.logger.info("processing mapreduce output file %d/%d" %
                        (i+1, len(ls)))
@@ -361,6 +439,7 @@ class Runner(object):
           if code == al_type.NO_HIT:
             outf.write("%s\n" % payload)
             continue
+          seq_len, payload = payload.split("\t", 1)
           blast_output_file.write("%s\n" % payload)
           seq_tag, more_fields = payload.split("\t", 1)
           if seq_tag != old_seq_tag:
@@ -369,9 +448,14 @@ class Runner(object):
               outf.write("\t%s" % more_fields)
             outf.write("\n")
             old_seq_tag = seq_tag
+            n_summary_hits = 0
+          if n_summary_hits < opt.summary_hits:
+            summary_file.write("%s\t%s\n" % (payload, seq_len))
+            n_summary_hits += 1
     for f in output_files.itervalues():
       f.close()
     blast_output_file.close()
+    summary_file.close()
 
 
 def main(argv):
@@ -384,6 +468,9 @@ def main(argv):
   except IndexError:
     parser.print_help()
     sys.exit(2)
+  if opt.summary_hits < 2:
+    # with a single hit per query, reclassify can't tell repeats apart
+    parser.error("--summary-hits must be at least 2")
 
   STR_GENERATOR.prefix = os.path.basename(input_fasta)
 
@@ -430,6 +517,9 @@ def main(argv):
     blast_output_hdfs = runner.run_blast(blast_input_hdfs, db_archive_hdfs,
                                          opt)
     runner.collect_output(blast_output_hdfs, opt)
+    if opt.merge:
+      merge_output_hdfs = runner.run_merge(blast_output_hdfs, opt)
+      runner.collect_merged(merge_output_hdfs, opt)
     logger.info("all done")
   finally:
     lfs.close()
@@ -21,9 +21,15 @@
 
 """
 Merge a collection of FASTA files into a single one.
+
+Input can be a zip or tar[.gz|.bz2] archive, a directory, a single
+FASTA file or a list of FASTA files; FASTA files that are not in an
+archive can be gzip or bzip2 compressed.
 """
 
-import sys, os, argparse, zipfile, tarfile, contextlib, logging
+import sys, os, argparse, zipfile, tarfile, contextlib, logging, gzip, bz2
+import collections, itertools
+import multiprocessing as mp
 
 from bl.core.seq.io.fasta import SimpleFastaReader as FastaReader
 from bl.core.utils import NullLogger
@@ -31,6 +37,33 @@ from bl.core.utils import NullLogger
 
 LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 DEFAULT_OUTPUT = "output.fa"
+OPENERS = {
+  ".gz": gzip.open,
+  ".bz2": bz2.BZ2File,
+  }
+
+
+def open_fasta(fn):
+  """
+  Open a (possibly compressed) FASTA file.
+  """
+  opener = OPENERS.get(os.path.splitext(fn)[1])
+  if opener is None:
+    return open(fn, "rU")
+  return opener(fn)
+
+
+def get_tag(fn, compressed=False):
+  """
+  Get the sequence tag prefix for FASTA file ``fn``: its basename
+  without extension. If ``compressed`` is True (standalone files, which
+  are decompressed by :func:`open_fasta`), compression extensions are
+  removed first.
+  """
+  root, ext = os.path.splitext(os.path.basename(fn))
+  if compressed and ext in OPENERS:
+    root = os.path.splitext(root)[0]
+  return root
 
 
 def make_logger(level_str="INFO", filename=None):
@@ -51,6 +84,30 @@ def make_logger(level_str="INFO", filename=None):
   return logger
 
 
+def read_zip_member(args):
+  """
+  Read all records from a FASTA member of a zip archive, tagging
+  headers as :class:`Multiplexer` does. Used by worker processes.
+  """
+  fn, name, sep = args
+  tag = get_tag(name)
+  with zipfile.ZipFile(fn) as a:
+    with a.open(name, "rU") as f:
+      return [(sep.join((tag, header)), seq)
+              for header, seq in FastaReader(f)]
+
+
+def read_fasta_file(args):
+  """
+  Read all records from a FASTA file, tagging headers as
+  :class:`Multiplexer` does. Used by worker processes.
+  """
+  fn, sep = args
+  tag = get_tag(fn, compressed=True)
+  with open_fasta(fn) as f:
+    return [(sep.join((tag, header)), seq) for header, seq in FastaReader(f)]
+
+
 class Multiplexer(object):
 
   SEP = "/"
@@ -59,70 +116,153 @@ class Multiplexer(object):
     self.logger.critical(msg)
     raise exc_type(msg)
 
+  def __iter_tar(self):
+    # read the archive as a stream, so that compressed data is
+    # decompressed only once; progress is measured in raw bytes read
+    size = os.path.getsize(self.input)
+    with open(self.input, "rb") as raw:
+      with contextlib.closing(tarfile.open(fileobj=raw, mode="r|*")) as a:
+        for m in a:
+          if not m.isfile():
+            continue
+          progress = "%.0f%%" % (100. * raw.tell() / max(size, 1))
+          yield m.name, progress, contextlib.closing(a.extractfile(m))
+
+  def __iter_zip(self):
+    with zipfile.ZipFile(self.input) as a:
+      members = a.infolist()
+      for i, m in enumerate(members):
+        if m.file_size <= 0:
+          continue
+        progress = "%d/%d" % (i+1, len(members))
+        yield m.filename, progress, a.open(m, "rU")
+
+  def __iter_files(self):
+    for i, fn in enumerate(self.input):
+      progress = "%d/%d" % (i+1, len(self.input))
+      yield fn, progress, open_fasta(fn)
+
+  def __imap(self, worker, tasks, names):
+    # members are decompressed and parsed by worker processes, with at
+    # most 2 * processes members in flight, so that decoded members do
+    # not pile up in memory when the consumer is slow; results are
+    # returned in member order, so the output does not change
+    pool = mp.Pool(self.processes)
+    try:
+      tasks = iter(tasks)
+      pending = collections.deque(
+        pool.apply_async(worker, (t,))
+        for t in itertools.islice(tasks, 2 * self.processes)
+        )
+      i = 0
+      while pending:
+        records = pending.popleft().get()
+        for t in itertools.islice(tasks, 1):
+          pending.append(pool.apply_async(worker, (t,)))
+        self.logger.info("processing [%d/%d]: %r" % (
+          i+1, len(names), os.path.basename(names[i])
+          ))
+        i += 1
+        for r in records:
+          yield r
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def __iter_zip_parallel(self):
+    with zipfile.ZipFile(self.input) as a:
+      names = [m.filename for m in a.infolist() if m.file_size > 0]
+    tasks = [(self.input, n, self.sep) for n in names]
+    return self.__imap(read_zip_member, tasks, names)
+
+  def __iter_files_parallel(self):
+    tasks = [(fn, self.sep) for fn in self.input]
+    return self.__imap(read_fasta_file, tasks, self.input)
+
   def __set_protocol_tar(self):
-    self.open = tarfile.open
-    self.getmembers = lambda a: a.getmembers()
-    self.getname = lambda m: m.name
-    self.isdir = lambda m: m.isdir()
-    self.extractfile = lambda a, m: contextlib.closing(a.extractfile(m))
+    self.itermembers = self.__iter_tar
+    self.iter_parallel = None  # members can only be read in sequence
+    self.compressed = False
 
   def __set_protocol_zip(self):
-    self.open = zipfile.ZipFile
-    self.getmembers = lambda a: a.infolist()
-    self.getname = lambda m: m.filename
-    self.isdir = lambda m: m.file_size <= 0
-    self.extractfile = lambda a, m: a.open(m, "rU")
+    self.itermembers = self.__iter_zip
+    self.iter_parallel = self.__iter_zip_parallel
+    self.compressed = False
+
+  def __set_protocol_files(self):
+    self.itermembers = self.__iter_files
+    self.iter_parallel = self.__iter_files_parallel
+    self.compressed = True
 
   def __set_protocol(self, fn):
-    if not isinstance(fn, basestring):  # TODO: support a list of filenames
-      self.__critical("not a string: %r" % (fn,), TypeError)
+    if isinstance(fn, (list, tuple)):
+      self.logger.debug("reading from a list of %d files" % len(fn))
+      self.__set_protocol_files()
+      return list(fn)
+    if not isinstance(fn, basestring):
+      self.__critical("not a string or list: %r" % (fn,), TypeError)
+    if os.path.isdir(fn):
+      self.logger.debug("%r is a directory" % (fn,))
+      self.__set_protocol_files()
+      return sorted(
+        os.path.join(fn, n) for n in os.listdir(fn)
+        if not n.startswith(".") and os.path.isfile(os.path.join(fn, n))
+        )
     try:
       if tarfile.is_tarfile(fn):
         self.logger.debug("%r looks like a tar file" % (fn,))
         self.__set_protocol_tar()
-        return
+        return fn
     except IOError as e:
       self.__critical(str(e), IOError)
     if zipfile.is_zipfile(fn):
       self.logger.debug("%r looks like a zip file" % (fn,))
       self.__set_protocol_zip()
-      return
-    self.__critical("unsupported archive format: %r" % (fn,), ValueError)
+      return fn
+    if os.path.isfile(fn):
+      self.logger.debug("%r is a single FASTA file" % (fn,))
+      self.__set_protocol_files()
+      return [fn]
+    self.__critical("no such file or directory: %r" % (fn,), IOError)
 
-  def __init__(self, fasta_in, sep=SEP, logger=None):
+  def __init__(self, fasta_in, sep=SEP, logger=None, processes=1):
     self.logger = logger or NullLogger()
-    self.__set_protocol(fasta_in)
-    self.input = fasta_in
+    self.input = self.__set_protocol(fasta_in)
     self.sep = sep
+    self.processes = processes
 
   def __iter__(self):
+    if self.processes > 1 and self.iter_parallel is not None:
+      return self.iter_parallel()
+    return self.__iter_sequential()
+
+  def __iter_sequential(self):
     sep = self.sep
-    with self.open(self.input) as a:
-      members = self.getmembers(a)
-      for i, m in enumerate(members):
-        basename = os.path.basename(self.getname(m))
-        self.logger.info(
-          "processing [%d/%d]: %r" % (i+1, len(members), basename)
-          )
-        if self.isdir(m):
-          continue
-        with self.extractfile(a, m) as f:
-          tag = os.path.splitext(basename)[0]
-          reader = FastaReader(f)
-          for header, seq in reader:
-            yield sep.join((tag, header)), seq
+    for name, progress, member_file in self.itermembers():
+      self.logger.info(
+        "processing [%s]: %r" % (progress, os.path.basename(name))
+        )
+      with member_file as f:
+        tag = get_tag(name, self.compressed)
+        reader = FastaReader(f)
+        for header, seq in reader:
+          yield sep.join((tag, header)), seq
 
 
 def make_parser():
   desc = "Merge a collection of FASTA files into a single one"
   parser = argparse.ArgumentParser(description=desc)
-  parser.add_argument('input', metavar="ZIP_ARCHIVE",
-                      help='zip archive of FASTA files')
+  parser.add_argument('input', metavar="INPUT", nargs="+",
+                      help='zip or tar archive of FASTA files, directory '
+                      'of FASTA files or list of FASTA files')
   parser.add_argument('-o', '--output', metavar="FILE",
                       help='output FASTA file', default=DEFAULT_OUTPUT)
   parser.add_argument('--log-file', metavar="FILE", help='log file [stderr]')
   parser.add_argument('--log-level', type=str, choices=LOG_LEVELS,
                       help='logging level', default='INFO')
+  parser.add_argument('--processes', metavar="INT", type=int, default=1,
+                      help='n. of worker processes (zip archives, '
+                      'directories and lists of files only)')
   return parser
 
 
@@ -130,7 +270,9 @@ def main(argv):
   parser = make_parser()
   args = parser.parse_args(argv)
   logger = make_logger(level_str=args.log_level, filename=args.log_file)
-  multiplexer = Multiplexer(args.input, logger=logger)
+  fasta_in = args.input[0] if len(args.input) == 1 else args.input
+  multiplexer = Multiplexer(fasta_in, logger=logger,
+                            processes=args.processes)
   with open(args.output, "w") as fo:
     for header, seq in multiplexer:
       fo.write(">%s\n%s\n" % (header, seq))
@@ -0,0 +1,119 @@
+# BEGIN_COPYRIGHT
+# 
+# Copyright (C) 2013-2014 CRS4.
+# 
+# This file is part of vispa.
+# 
+# vispa is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+# 
+# vispa is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# vispa.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# END_COPYRIGHT
+
+
+"""
+Re-apply repeat classification rules to a top hit summary.
+
+The input is the top_hits.tsv file written by mr_blast: for each
+query, its best tabular BLAST hits (with raw scores), in order of
+decreasing score, each followed by the query length. The program
+writes new unambiguous and repeat files, in the same format as the
+ones written by mr_blast.
+"""
+
+import sys, os, argparse, errno
+
+import numpy as np
+
+import bl.tiget.mr.blast.al_type as al_type
+from bl.tiget.hit import Hit
+from bl.tiget.repeats import HIT_DTYPE, classify
+
+
+OUTPUT_FILENAMES = {
+  al_type.UNAMBIGUOUS: "unambiguous",
+  al_type.REPEAT: "repeat",
+  }
+
+
+def read_summary(f):
+  """
+  Read a top hit summary from the open file ``f``.
+
+  Returns a (tags, top_hits, seq_lens, hits) tuple, where ``top_hits``
+  are the (unparsed) best hits for each query tag and ``hits`` is a
+  :data:`~bl.tiget.repeats.HIT_DTYPE` array for :func:`classify`.
+  """
+  tags, top_hits, seq_lens, records = [], [], [], []
+  for line in f:
+    line = line.rstrip("\r\n")
+    if not line:
+      continue
+    hit_line, seq_len = line.rsplit("\t", 1)
+    hit = Hit.from_line(hit_line, "\t")
+    if not tags or hit.q_id != tags[-1]:
+      tags.append(hit.q_id)
+      top_hits.append(hit_line)
+      seq_lens.append(int(seq_len))
+    records.append((len(tags)-1, hit.q_start, hit.q_end, hit.score))
+  return tags, top_hits, seq_lens, np.array(records, dtype=HIT_DTYPE)
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(
+    description=__doc__.strip(),
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+  parser.add_argument("input", metavar="INPUT", help="top hit summary")
+  parser.add_argument("--out-prefix", metavar="STRING", default="",
+                      help="prefix for output files")
+  parser.add_argument("-v", "--tiget-min-al2seq-percent", type=float,
+                      metavar="FLOAT", default=15.0,
+                      help="min O1-O2 value for unique hits")
+  parser.add_argument("-z", "--tiget-min-score-diff", type=float,
+                      metavar="FLOAT", default=20.0,
+                      help="min S1-S2 value for unique hits")
+  return parser
+
+
+def main(argv):
+  parser = make_parser()
+  args = parser.parse_args(argv[1:])
+  with open(args.input) as f:
+    tags, top_hits, seq_lens, hits = read_summary(f)
+  codes = classify(hits, seq_lens,
+                   min_al2seq=args.tiget_min_al2seq_percent / 100,
+                   min_score_diff=args.tiget_min_score_diff)
+  out_dir = os.path.dirname(args.out_prefix)
+  if out_dir:
+    try:
+      os.makedirs(out_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+  output_files = dict((k, open(args.out_prefix+fn, "w"))
+                      for k, fn in OUTPUT_FILENAMES.iteritems())
+  try:
+    for tag, top_hit, code in zip(tags, top_hits, codes):
+      if code == al_type.UNAMBIGUOUS:
+        output_files[code].write("%s\n" % top_hit)
+      else:
+        output_files[code].write("%s\n" % tag)
+  finally:
+    for f in output_files.itervalues():
+      f.close()
+  for code, fn in sorted(OUTPUT_FILENAMES.iteritems()):
+    print "%s\t%d" % (args.out_prefix+fn, (codes == code).sum())
+
+
+if __name__ == "__main__":
+  main(sys.argv)
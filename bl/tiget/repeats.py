@@ -19,38 +19,110 @@
 # 
 # END_COPYRIGHT
 
-def al2seq(result, seq_len):
-  query_start = int(result[6])
-  query_end = int(result[7])
-  return abs(query_start - query_end) / float(seq_len)
+from operator import attrgetter
 
+import numpy as np
 
-score = lambda result: float(result[-1])
+
+HIT_DTYPE = np.dtype([
+  ("query", np.int64),    # index of the query in the seq_lens array
+  ("q_start", np.int64),
+  ("q_end", np.int64),
+  ("score", np.float64),
+  ])
+
+
+score = attrgetter("score")
+
+
+def _first_max(hits, scores, n_queries):
+  """
+  For each query, find the index of the first hit with the highest score.
+
+  Returns a (max_scores, indices) tuple; queries with no eligible hits
+  get a score of -inf and an index equal to len(hits).
+  """
+  q = hits["query"]
+  max_scores = np.empty(n_queries, dtype=np.float64)
+  max_scores.fill(-np.inf)
+  np.maximum.at(max_scores, q, scores)
+  mask = (scores == max_scores[q]) & (scores > -np.inf)
+  indices = np.empty(n_queries, dtype=np.int64)
+  indices.fill(len(hits))
+  np.minimum.at(indices, q[mask], np.flatnonzero(mask))
+  return max_scores, indices
+
+
+def classify(hits, seq_lens, min_al2seq=.15, min_score_diff=20.):
+  """
+  Classify a batch of queries according to tiget rules.
+
+  For each query, only the two best hits are looked at: they are found
+  by partial selection (two grouped max reductions), without sorting
+  the hits. Among hits with the same score, the one that comes first
+  in ``hits`` wins, as with the stable sort in :func:`is_repeat`.
+
+  Returns an array of :mod:`~bl.tiget.mr.blast.al_type` codes, one
+  for each query.
+
+  :type hits: :class:`numpy.ndarray`
+  :param hits: structured array with (at least) the fields in
+    :data:`HIT_DTYPE`; ``query`` is the index of the query in
+    ``seq_lens``
+
+  :type seq_lens: :class:`numpy.ndarray`
+  :param seq_lens: lengths of the query sequences
+  """
+  # imported here to avoid a circular import through bl.tiget.mr.blast
+  import bl.tiget.mr.blast.al_type as al_type
+  seq_lens = np.asarray(seq_lens, dtype=np.float64)
+  n_queries = len(seq_lens)
+  codes = np.empty(n_queries, dtype=np.int8)
+  codes.fill(al_type.NO_HIT)
+  if len(hits) == 0:
+    return codes
+  q = hits["query"]
+  scores = hits["score"].astype(np.float64)
+  n_hits = np.bincount(q, minlength=n_queries)
+  codes[n_hits == 1] = al_type.UNAMBIGUOUS
+  s1, i1 = _first_max(hits, scores, n_queries)
+  multi = np.flatnonzero(n_hits > 1)
+  scores[i1[multi]] = -np.inf
+  s2, i2 = _first_max(hits, scores, n_queries)
+  i1, i2, s1, s2 = i1[multi], i2[multi], s1[multi], s2[multi]
+  al_len = np.abs(hits["q_start"] - hits["q_end"])
+  lens = seq_lens[multi]
+  al_diff = np.abs(al_len[i1] / lens - al_len[i2] / lens)
+  repeat = (al_diff <= min_al2seq) | (s1 - s2 <= min_score_diff)
+  codes[multi] = np.where(repeat, al_type.REPEAT, al_type.UNAMBIGUOUS)
+  return codes
 
 
 def is_repeat(seq_len, blast_results, min_al2seq=.15, min_score_diff=20.):
   """
   Mark a repeat according to tiget rules (FIXME: summarize).
 
+  This is the single-query counterpart of :func:`classify`, with the
+  same rules and results, for callers (like the BLAST mapper) that
+  handle one query at a time: with only a few hits, building arrays
+  would cost more than the comparisons. Returns None if there are no
+  hits, True for a repeat and False otherwise.
+
   NOTE: sorts ``blast_results`` by decreasing score.
 
   :type seq_len: int
   :param seq_len: length of the query sequence
 
   :type blast_results: list
-  :param blast_results: list of tabular blast hits as lists of strings
+  :param blast_results: list of :class:`~bl.tiget.hit.Hit` objects
   """
   blast_results.sort(key=score, reverse=True)
-  try:
-    r1 = blast_results[0]
-  except IndexError:
+  if not blast_results:
     return None  # no match
-  try:
-    r2 = blast_results[1]
-  except IndexError:
+  if len(blast_results) == 1:
     return False
-  if abs(al2seq(r1, seq_len) - al2seq(r2, seq_len)) <= min_al2seq:
-    return True
-  if score(r1) - score(r2) <= min_score_diff:
-    return True
-  return False
+  r1, r2 = blast_results[:2]
+  seq_len = float(seq_len)
+  al_diff = abs(abs(r1.q_start - r1.q_end) / seq_len -
+                abs(r2.q_start - r2.q_end) / seq_len)
+  return al_diff <= min_al2seq or r1.score - r2.score <= min_score_diff
@@ -131,6 +131,7 @@ if __name__ == "__main__":
       'bl.tiget.pipeline',
       'bl.tiget.mr',
       'bl.tiget.mr.blast',
+      'bl.tiget.mr.merge',
       ],
     cmdclass={"sdist": sdist, "build_py": build_py},
     )